@@ -0,0 +1,373 @@
+'''
+Runs things2md.py against a small Things database, built for each test, and checks its output.
+The script and the example configuration are copied to a temporary folder, so that its caches are kept there.
+'''
+import errno
+import fcntl
+import glob
+import json
+import os
+import pickle
+import plistlib
+import re
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+SCRIPT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCHEMA_SQL = '''
+    CREATE TABLE TMTask (uuid TEXT PRIMARY KEY, type INTEGER, trashed INTEGER DEFAULT 0, title TEXT, status INTEGER,
+                         area TEXT, project TEXT, heading TEXT, notes TEXT, start INTEGER, startDate INTEGER,
+                         deadline INTEGER, reminderTime INTEGER, stopDate REAL, creationDate REAL,
+                         userModificationDate REAL, "index" INTEGER, todayIndex INTEGER, rt1_recurrenceRule BLOB,
+                         deadlineSuppressionDate INTEGER, startBucket INTEGER);
+    CREATE TABLE TMArea (uuid TEXT PRIMARY KEY, title TEXT, visible INTEGER, "index" INTEGER);
+    CREATE TABLE TMAreaTag (areas TEXT, tags TEXT);
+    CREATE TABLE TMTag (uuid TEXT PRIMARY KEY, title TEXT, shortcut TEXT, usedDate REAL, parent TEXT, "index" INTEGER);
+    CREATE TABLE TMTaskTag (tasks TEXT, tags TEXT);
+    CREATE TABLE TMChecklistItem (uuid TEXT PRIMARY KEY, userModificationDate REAL, creationDate REAL, title TEXT,
+                                  status INTEGER, stopDate REAL, "index" INTEGER, task TEXT);
+    CREATE TABLE Meta (key TEXT PRIMARY KEY, value TEXT);
+    CREATE TABLE TMSettings (uuid TEXT PRIMARY KEY, uriSchemeAuthenticationToken TEXT);
+    '''
+
+DAY = 24 * 60 * 60
+
+class Things2mdTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        shutil.copy(os.path.join(SCRIPT_DIR, "things2md.py"), self.directory)
+        shutil.copy(os.path.join(SCRIPT_DIR, "things2md.json.example"), os.path.join(self.directory, "things2md.json"))
+        self.database_file_path = os.path.join(self.directory, "main.sqlite")
+        self.database = sqlite3.connect(self.database_file_path)
+        self.addCleanup(self.database.close)
+        self.database.executescript(SCHEMA_SQL)
+        self.database.execute("INSERT INTO Meta VALUES ('databaseVersion', ?)", (plistlib.dumps(26).decode(),))
+        self.database.execute("INSERT INTO TMSettings VALUES ('settings', 'token')")
+        self.now = time.time()
+
+    def add_area(self, uuid, title):
+        self.database.execute("INSERT INTO TMArea VALUES (?, ?, 1, 0)", (uuid, title))
+        self.database.commit()
+
+    def add_task(self, uuid, title, type=0, status=0, project=None, stop_date=None, area=None, heading=None):
+        self.database.execute('''
+            INSERT INTO TMTask (uuid, type, title, status, area, project, heading, notes, start, stopDate, creationDate,
+                                userModificationDate, "index", todayIndex)
+            VALUES (?, ?, ?, ?, ?, ?, ?, '', 1, ?, ?, ?, 0, 0)
+            ''', (uuid, type, title, status, area, project, heading, stop_date, self.now - 30 * DAY,
+                  stop_date or self.now - 30 * DAY))
+        self.database.commit()
+
+    def add_tag(self, task_uuid, title):
+        self.database.execute("INSERT OR IGNORE INTO TMTag (uuid, title, \"index\") VALUES (?, ?, 0)", (f"TAG-{title}", title))
+        self.database.execute("INSERT INTO TMTaskTag VALUES (?, ?)", (task_uuid, f"TAG-{title}"))
+        self.database.commit()
+
+    def run_things2md(self, *args):
+        return subprocess.run([sys.executable, os.path.join(self.directory, "things2md.py"), *args],
+                              env=dict(os.environ, THINGSDB=self.database_file_path),
+                              capture_output=True, text=True, timeout=60)
+
+    def test_since_last_outputs_tasks_of_completed_projects(self):
+        # a task completed in a project completed since, as is usual in the logbook
+        self.add_task("P1", "Old Project", type=1, status=3, stop_date=self.now - 2 * DAY)
+        self.add_task("T1", "Old task", status=3, project="P1", stop_date=self.now - 5 * DAY)
+        self.add_task("T2", "Recent task", status=3, stop_date=self.now - DAY)
+        state_file_path = os.path.join(self.directory, "state.json")
+
+        result = self.run_things2md("--since-last", state_file_path)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertIn("[[Old Project]] // Old task", result.stdout)
+        self.assertIn("Recent task", result.stdout)
+
+        result = self.run_things2md("--since-last", state_file_path)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertNotIn("task", result.stdout)
+
+    def test_search_outputs_tasks_of_completed_projects(self):
+        # search results are of any status, from any project, including those completed long ago
+        self.add_task("P1", "Old Project", type=1, status=3, stop_date=self.now - 300 * DAY)
+        self.add_task("T1", "Review the plan", status=3, project="P1", stop_date=self.now - 310 * DAY)
+        self.add_task("T2", "Review the budget")
+
+        result = self.run_things2md("--search", "review")
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertIn("[[Old Project]] // Review the plan", result.stdout)
+        self.assertIn("Review the budget", result.stdout)
+
+    def test_where_status_and_date_terms_match_completed_tasks(self):
+        # without a date argument, only uncompleted tasks are matched, unless the expression is about status or dates
+        self.add_task("T1", "Completed task", status=3, stop_date=self.now - DAY)
+        self.add_task("T2", "Canceled task", status=2, stop_date=self.now - 400 * DAY)
+        self.add_task("T3", "Open task")
+
+        result = self.run_things2md("--where", "status:completed")
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertIn("Completed task", result.stdout)
+        self.assertNotIn("Canceled task", result.stdout)
+        self.assertNotIn("Open task", result.stdout)
+
+        since = time.strftime("%Y-%m-%d", time.localtime(self.now - 2 * DAY))
+        result = self.run_things2md("--where", f"date>={since}")
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertIn("Completed task", result.stdout)
+        self.assertNotIn("Canceled task", result.stdout)
+
+        result = self.run_things2md("--where", "title~task")
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.strip().count("task"), 1, result.stdout)
+        self.assertIn("Open task", result.stdout)
+
+    def test_reindex_vault_picks_up_aliases_edited_in_place(self):
+        vault_path = os.path.join(self.directory, "vault")
+        os.makedirs(os.path.join(vault_path, "Projects"))
+        note_file_path = os.path.join(vault_path, "Projects", "Launch Plan.md")
+        with open(note_file_path, "w") as note_file:
+            note_file.write("# Launch Plan\n")
+        config_file_path = os.path.join(self.directory, "things2md.json")
+        with open(config_file_path) as config_file:
+            config = json.load(config_file)
+        config['vault'] = vault_path
+        with open(config_file_path, "w") as config_file:
+            json.dump(config, config_file)
+        self.add_task("P1", "Client Launch", type=1)
+        self.add_task("T1", "Send the invite", status=3, project="P1", stop_date=self.now - DAY)
+
+        result = self.run_things2md("--range", "1 week ago")
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertIn("Client Launch // Send the invite", result.stdout)
+        self.assertNotIn("[[", result.stdout)
+
+        # adding an alias doesn't change the note's folder, so it's only picked up when the vault is re-read
+        with open(note_file_path, "w") as note_file:
+            note_file.write("---\naliases: [Client Launch]\n---\n# Launch Plan\n")
+        result = self.run_things2md("--range", "1 week ago", "--reindex-vault")
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertIn("[[Launch Plan|Client Launch]] // Send the invite", result.stdout)
+
+    def test_pages_hold_limit_tasks_despite_skip_tags(self):
+        # the newest tasks are skipped (see skip_tags in things2md.json.example)
+        for i in range(1, 5):
+            self.add_task(f"T{i}", f"Task {i}", status=3, stop_date=self.now - i * DAY)
+        self.add_task("T0", "Personal task", status=3, stop_date=self.now - DAY / 2)
+        self.add_tag("T0", "personal")
+
+        result = self.run_things2md("--range", "1 week ago", "--limit", "1")
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertIn("Task 1", result.stdout)
+        self.assertIn("continue with: --after T1", result.stderr)
+        self.assertNotIn("No results", result.stderr)
+
+    def add_headings_fixture(self):
+        # Alpha has a task under a heading, and one directly in it
+        self.add_area("A1", "Work")
+        self.add_area("A2", "Home")
+        self.add_task("P1", "Alpha", type=1, area="A1")
+        self.add_task("P2", "Beta", type=1, area="A2")
+        self.add_task("H1", "Phase one", type=2, project="P1")
+        self.add_task("T1", "Alpha task", status=3, project="P1", stop_date=self.now - 3 * DAY)
+        self.add_task("T2", "Alpha heading task", status=3, heading="H1", stop_date=self.now - DAY)
+        self.add_task("T3", "Loose task", status=3, stop_date=self.now - 2 * DAY)
+        self.add_task("T4", "Beta task", status=3, project="P2", stop_date=self.now - 4 * DAY)
+
+    def assertInOrder(self, output, *texts):
+        positions = [output.find(text) for text in texts]
+        self.assertNotIn(-1, positions, output)
+        self.assertEqual(positions, sorted(positions), output)
+
+    def test_orderby_project_orders_tasks_under_headings_by_their_project(self):
+        self.add_headings_fixture()
+        result = self.run_things2md("--range", "1 week ago", "--orderby", "project")
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertInOrder(result.stdout, "Loose task", "Alpha heading task", "Alpha task", "Beta task")
+
+    def test_orderby_area_orders_tasks_under_headings_by_their_project_area(self):
+        self.add_headings_fixture()
+        result = self.run_things2md("--range", "1 week ago", "--orderby", "area")
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertInOrder(result.stdout, "Loose task", "Beta task", "Alpha heading task", "Alpha task")
+
+    def test_output_dir_removes_notes_of_renamed_tasks_and_tells_names_apart_ignoring_case(self):
+        self.add_task("T1", "Plan", status=3, stop_date=self.now - DAY)
+        self.add_task("T2", "plan", status=3, stop_date=self.now - 2 * DAY)
+        self.add_task("T3", "Draft", status=3, stop_date=self.now - DAY)
+        output_dir = os.path.join(self.directory, "notes")
+
+        result = self.run_things2md("--range", "1 week ago", "--output-dir", output_dir)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(sorted(name.casefold() for name in os.listdir(output_dir)),
+                         [".things2md_manifest.json", "draft.md", "plan t2.md", "plan.md"])
+        result = self.run_things2md("--range", "1 week ago", "--output-dir", output_dir)
+        self.assertIn("Wrote 0 notes", result.stderr)
+
+        # notes edited since they were written are kept
+        with open(os.path.join(output_dir, "Draft.md"), "a") as note_file:
+            note_file.write("My own notes\n")
+        self.database.execute("UPDATE TMTask SET title = 'Budget', userModificationDate = ? WHERE uuid = 'T1'", (self.now,))
+        self.database.execute("UPDATE TMTask SET title = 'Final', userModificationDate = ? WHERE uuid = 'T3'", (self.now,))
+        self.database.commit()
+        result = self.run_things2md("--range", "1 week ago", "--output-dir", output_dir)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertIn("removed", result.stderr)
+        # "plan" no longer needs telling apart from "Plan"
+        self.assertEqual(sorted(name.casefold() for name in os.listdir(output_dir)),
+                         [".things2md_manifest.json", "budget.md", "draft.md", "final.md", "plan.md"])
+        with open(os.path.join(output_dir, ".things2md_manifest.json")) as manifest_file:
+            self.assertEqual(sorted(json.load(manifest_file)), ["Budget.md", "Final.md", "plan.md"])
+
+    def test_cached_output_follows_renamed_completed_projects(self):
+        self.add_task("P1", "Old Project", type=1, status=3, stop_date=self.now - 300 * DAY)
+        self.add_task("T1", "Feed the zebra", status=3, project="P1", stop_date=self.now - 310 * DAY)
+
+        result = self.run_things2md("--search", "zebra")
+        self.assertIn("[[Old Project]] // Feed the zebra", result.stdout)
+
+        self.database.execute("UPDATE TMTask SET title = 'New Project', userModificationDate = ? WHERE uuid = 'P1'", (self.now,))
+        self.database.commit()
+        result = self.run_things2md("--search", "zebra")
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertIn("[[New Project]] // Feed the zebra", result.stdout)
+
+    def test_limit_and_after_page_through_tasks(self):
+        for i in range(1, 6):
+            self.add_task(f"T{i}", f"Task {i}", status=3, stop_date=self.now - i * DAY)
+
+        pages = []
+        args = ["--range", "1 week ago", "--limit", "2"]
+        for _ in range(3):
+            result = self.run_things2md(*args)
+            self.assertEqual(result.returncode, 0, result.stderr)
+            pages.append(re.findall(r"Task \d", result.stdout))
+            if "continue with: --after " not in result.stderr:
+                break
+            args = ["--range", "1 week ago", "--limit", "2", "--after", result.stderr.split("--after ")[1].split()[0]]
+        self.assertEqual(pages, [["Task 1", "Task 2"], ["Task 3", "Task 4"], ["Task 5"]])
+
+    def test_limit_and_after_are_validated(self):
+        self.assertEqual(self.run_things2md("--range", "1 week ago", "--limit", "-1").returncode, 2)
+        result = self.run_things2md("--search", "task", "--after", "T1")
+        self.assertEqual(result.returncode, errno.EINVAL)
+        self.assertIn("--after can't be used with --search", result.stderr)
+
+    def test_groupby_nests_groups(self):
+        self.add_headings_fixture()
+        result = self.run_things2md("--range", "1 week ago", "--groupby", "area", "project")
+        self.assertEqual(result.returncode, 0, result.stderr)
+        # tasks without an area come first, without a header; groups are in the order of their first task
+        self.assertInOrder(result.stdout, "Loose task", "## Work", "## ☑️ Alpha", "Alpha heading task", "Alpha task",
+                           "## Home", "## ☑️ Beta", "Beta task")
+        self.assertEqual(result.stdout.count("## ☑️ Alpha"), 1, result.stdout)
+
+    def test_stats_counts_completed_and_canceled_tasks(self):
+        self.add_headings_fixture()
+        self.add_task("T5", "Canceled Beta task", status=2, project="P2", stop_date=self.now - DAY)
+        self.add_task("T6", "Open Beta task", project="P2")
+        result = self.run_things2md("--stats", "project", "--range", "1 week ago")
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertIn("| Alpha | 2 | 0 | 0% |", result.stdout)
+        self.assertIn("| Beta | 1 | 1 | 50% |", result.stdout)
+        self.assertInOrder(result.stdout, "| Alpha |", "| Beta |")
+
+    def test_where_expressions_are_parsed_with_precedence(self):
+        self.add_headings_fixture()
+        result = self.run_things2md("--range", "1 week ago", "--where", 'title~task and not (project:Beta or title~"alpha heading")')
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertIn("Alpha task", result.stdout)
+        self.assertIn("Loose task", result.stdout)
+        self.assertNotIn("Beta task", result.stdout)
+        self.assertNotIn("Alpha heading task", result.stdout)
+
+        for expression, error in [("tag:", "expected a term"), ("title~task and (project:Beta", "missing )"),
+                                  ("title~task project:Beta", "expected and/or"), ("status:done", "status must be one of")]:
+            result = self.run_things2md("--where", expression)
+            self.assertEqual(result.returncode, errno.EINVAL, expression)
+            self.assertIn(error, result.stderr, expression)
+
+    def test_tree_outlines_a_project_under_its_headings(self):
+        self.add_task("P1", "Alpha", type=1)
+        self.add_task("H1", "Phase one", type=2, project="P1")
+        self.add_task("T1", "Loose step", project="P1")
+        self.add_task("T2", "First step", heading="H1")
+        result = self.run_things2md("--project", "Alpha", "--tree")
+        self.assertEqual(result.returncode, 0, result.stderr)
+        lines = result.stdout.splitlines()
+        self.assertIn("Loose step", lines[0])
+        self.assertEqual(lines[1], "- **Phase one**")
+        self.assertTrue(lines[2].startswith("\t- [ ]") and "First step" in lines[2], result.stdout)
+
+    def test_output_dir_only_rewrites_changed_notes(self):
+        self.add_task("T1", "Plan", status=3, stop_date=self.now - DAY)
+        self.add_task("T2", "Draft", status=3, stop_date=self.now - DAY)
+        output_dir = os.path.join(self.directory, "notes")
+        result = self.run_things2md("--range", "1 week ago", "--output-dir", output_dir)
+        self.assertIn("Wrote 2 notes", result.stderr)
+        os.utime(os.path.join(output_dir, "Plan.md"), (0, 0))
+
+        self.database.execute("UPDATE TMTask SET title = 'Draft 2', userModificationDate = ? WHERE uuid = 'T2'", (self.now,))
+        self.database.commit()
+        result = self.run_things2md("--range", "1 week ago", "--output-dir", output_dir)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertIn("Wrote 1 notes", result.stderr)
+        self.assertIn("1 unchanged", result.stderr)
+        self.assertEqual(os.stat(os.path.join(output_dir, "Plan.md")).st_mtime, 0)
+
+    def test_archive_serves_past_dates(self):
+        self.add_task("T1", "Archived title", status=3, stop_date=self.now - 10 * DAY)
+        result = self.run_things2md("--archive")
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+        # changed in Things since it was archived
+        self.database.execute("UPDATE TMTask SET title = 'Current title' WHERE uuid = 'T1'")
+        self.database.commit()
+        day = time.strftime("%Y-%m-%d", time.localtime(self.now - 10 * DAY))
+        result = self.run_things2md("--date", day)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertIn("Archived title", result.stdout)
+        # ranges up to today read the Things database
+        result = self.run_things2md("--range", "1 month ago")
+        self.assertIn("Current title", result.stdout)
+
+    def test_deadline_exits_with_etimedout_while_things_holds_its_lock(self):
+        self.add_task("T1", "Task", status=3, stop_date=self.now - DAY)
+        # as Things does while syncing
+        self.database.execute("BEGIN EXCLUSIVE")
+        started_at = time.monotonic()
+        result = self.run_things2md("--range", "1 week ago", "--deadline", "1")
+        self.database.rollback()
+        self.assertEqual(result.returncode, errno.ETIMEDOUT, result.stderr)
+        self.assertIn("no results were fetched", result.stderr)
+        self.assertLess(time.monotonic() - started_at, 4)
+
+    def test_concurrent_identical_runs_share_output(self):
+        self.add_task("T1", "Task", status=3, stop_date=self.now - DAY)
+        self.run_things2md("--range", "1 week ago")
+        lock_file_path, = glob.glob(os.path.join(self.directory, ".things2md_cache", "coalesce-*.lock"))
+
+        # a run started while another holds the lock waits for it, then outputs what it shared
+        with open(lock_file_path, "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            process = subprocess.Popen([sys.executable, os.path.join(self.directory, "things2md.py"), "--range", "1 week ago"],
+                                       env=dict(os.environ, THINGSDB=self.database_file_path),
+                                       stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+            wait_file_path = lock_file_path[:-len(".lock")] + ".wait"
+            for _ in range(200):
+                if os.path.exists(wait_file_path):
+                    break
+                time.sleep(0.01)
+            self.assertTrue(os.path.exists(wait_file_path))
+            with open(lock_file_path[:-len(".lock")] + ".pickle", "wb") as result_file:
+                pickle.dump(dict(finished_at=time.time(), stdout="Shared output\n", stderr=""), result_file)
+        stdout, stderr = process.communicate(timeout=60)
+        self.assertEqual(process.returncode, 0, stderr)
+        self.assertEqual(stdout, "Shared output\n")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,123 +2,361 @@
 # For use in Obsidian for Daily Notes.
 # Execute from Obsidian with the shellcommands community plugin.
 
+import os
+import sys
+
+THINGS2MD_CONFIG_FILE = './things2md.json'
+THINGS2MD_CACHE_DIR = './.things2md_cache'
+
+# #############################################################################
+# SHELL COMPLETION
+# #############################################################################
+
+# names of projects, areas, tags, and templates for shell completion (see --completion), one per line, after
+# a line recording the state of the configuration and databases they were read from (see get_completion_state)
+THINGS2MD_COMPLETION_FILE = os.path.join(THINGS2MD_CACHE_DIR, 'completion.txt')
+
+def get_completion_state(database_file_paths):
+    '''
+    Returns the state of the configuration and the given databases, as recorded with the names for completion:
+    the THINGSDB environment variable (as things.py reads it), and the modification times of the files.
+    '''
+    def get_modified(file_path):
+        try:
+            return str(os.stat(file_path).st_mtime_ns)
+        except OSError:
+            return ""
+    state = [os.getenv("THINGSDB", ""), get_modified(os.path.join(os.path.dirname(__file__), THINGS2MD_CONFIG_FILE))]
+    for database_file_path in database_file_paths:
+        # Things writes to the database's write-ahead log, which is only merged into the database now and then
+        state += [database_file_path, get_modified(database_file_path) + "/" + get_modified(database_file_path + "-wal")]
+    return state
+
+def print_completion_names(lines, kind, prefix=""):
+    '''
+    Prints the names of the given kind (e.g., project) starting with the given prefix, ignoring case,
+    from the given lines of names for completion.
+    '''
+    prefix = prefix.casefold()
+    for line in lines:
+        line_kind, _, name = line.rstrip("\n").partition("\t")
+        if line_kind == kind and name.casefold().startswith(prefix):
+            print(name)
+
+# completion runs on every press of tab, so while the configuration and databases are unchanged, names are
+# output from the cache before importing anything else; otherwise, the cache is refreshed (see MAIN)
+if sys.argv[1:2] == ["--complete"] and 3 <= len(sys.argv) <= 4:
+    try:
+        with open(os.path.join(os.path.dirname(__file__), THINGS2MD_COMPLETION_FILE), encoding="utf-8") as completion_file:
+            completion_state = completion_file.readline().rstrip("\n").split("\t")
+            if completion_state == get_completion_state(completion_state[2::2]):
+                print_completion_names(completion_file, *sys.argv[2:])
+                exit(0)
+    except OSError:
+        pass
+
 import argparse
 from argparse import RawTextHelpFormatter
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import errno
+import fcntl
+import hashlib
+import heapq
+import io
 import json
-import os
+import pickle
 import re
-import sys
+import shlex
+import sqlite3
+import tempfile
+import threading
+import time
+import traceback
+from types import MappingProxyType
 import urllib.parse
 from datetime import datetime
 from dateutil.relativedelta import *
 import things
-
-THINGS2MD_CONFIG_FILE = './things2md.json'
+from things.database import Database
 
 # #############################################################################
 # CLI ARGUMENTS
 # #############################################################################
 
-_required_args = ["date", "due", "project", "projects", "range", "tag", "today"]
+_required_args = ["archive", "area", "completion", "date", "due", "project", "projects", "range", "search", "since", "since_last", "stats", "tag", "today", "until", "where"]
 _required_args_msg = f"At least one of these arguments is required: {', '.join(_required_args)}"
 
+def _non_negative_int(value):
+    if not value.isdecimal():
+        raise argparse.ArgumentTypeError(f"must be a whole number, 0 or more: {value}")
+    return int(value)
+
 parser = argparse.ArgumentParser(description="Things3 database -> Markdown conversion script.", formatter_class=RawTextHelpFormatter,
                                  epilog=f"{_required_args_msg}\n\nConfiguration options for {THINGS2MD_CONFIG_FILE} are documented in README.md")
 
+parser.add_argument('--after', help='Cursor to continue from, as reported when a previous page of tasks was truncated by --limit.')
+parser.add_argument('--archive', default=False, action='store_true', help='If set, copies completed tasks into a local archive, from which queries of past dates are then served,\nand exits. Only tasks completed or modified since the archive was last updated are copied.')
+parser.add_argument('--area', help='If provided, only tasks in this area (directly, or in its projects) are fetched.')
+parser.add_argument('--complete', nargs='+', metavar=('KIND', 'PREFIX'), help=argparse.SUPPRESS) # used by --completion's scripts
+parser.add_argument('--completion', choices=['bash', 'zsh'], help='If provided, outputs a script for this shell that adds a things2md command, which completes arguments\nand the names of projects, areas, tags, and templates (e.g., eval "$(python3 things2md.py --completion zsh)").')
 parser.add_argument('--date', help='Date to get completed tasks for, in ISO format (e.g., 2023-10-07).', type=datetime.fromisoformat)
+parser.add_argument('--deadline', type=float, metavar='SECONDS', help='If provided, the most seconds to spend querying Things (e.g., while it syncs). Once reached, the tasks\nfetched so far are output, marked as partial; or, if none were, the last complete output of the same command.\nEither way, the exit status is ETIMEDOUT.')
 parser.add_argument('--debug', default=False, action='store_true', help='If set will show script debug information.')
 parser.add_argument('--due', default=False, action='store_true', help='If set will show incomplete tasks with deadlines.')
-parser.add_argument('--groupby', choices=['area', 'date','project'], help='How to group the tasks. Use in conjunction with --orderby')
+parser.add_argument('--groupby', default=[], nargs='+', choices=['area', 'date', 'heading', 'project'], help='How to group the tasks. Provide more than one to nest groups (e.g., area project heading).')
+parser.add_argument('--limit', default=100, type=_non_negative_int, help='Maximum number of tasks to output per page (default: 100). Use 0 for no limit.')
 parser.add_argument('--orderby', default='date', choices=['area', 'date','index','project'], help='How to order the tasks.')
+parser.add_argument('--output-dir', metavar='DIR', help='If provided, each task is written to its own Markdown file in this directory (e.g., with --template note),\nnamed after the task. Files are only written if their contents changed.')
 parser.add_argument('--project', help='If provided, only tasks for this project are fetched.')
 parser.add_argument('--projects', default=False, action='store_true', help='If set will show a list of projects only.')
 parser.add_argument('--range', help='Relative date range to get completed tasks for (e.g., "today", "1 day ago", "1 week ago", "this week" which starts on Monday). Completed tasks are relative to midnight of the day requested.')
+parser.add_argument('--reindex-vault', default=False, action='store_true', help='If set, the whole vault is re-read for links (see README.md), rather than only its folders that changed;\ne.g., to pick up aliases added to notes.')
+parser.add_argument('--search', help='If provided, only tasks matching these words in their title, notes, or checklist are fetched, best matches first.\nAppend * to a word to match words starting with it.')
+parser.add_argument('--since', help='Get tasks completed on or after this date: an ISO date (e.g., 2026-03-14), week (e.g., 2026-W11),\nmonth (e.g., 2026-03), or year (e.g., 2026), or a day as in --range (e.g., "yesterday", "3 days ago").')
+parser.add_argument('--since-last', metavar='STATEFILE', help='If provided, only tasks completed since the previous run with this state file are fetched,\nand the state file is updated. Use with --range (e.g., "today") to bound the first run.')
+parser.add_argument('--snapshot', nargs='?', const=60, type=int, metavar='MAX_AGE', help='If set, queries run against a consistent copy of the Things database, which is reused\nfor up to MAX_AGE seconds (default: 60), or for as long as the database is unchanged.')
+parser.add_argument('--stats', nargs='*', choices=['day', 'project', 'area', 'tag'], help='If set will show counts of completed and canceled tasks instead, per day, project, area, and/or tag (default: all).\nUse with --date or --range to count tasks within that range.')
+parser.add_argument('--subtags', default=False, action='store_true', help='If set, --tag also matches tasks with any of its descendant tags (e.g., the tags nested under it in Things).')
 parser.add_argument('--tag', help='If provided, only uncompleted tasks with this tag are fetched.')
 parser.add_argument('--template', default='default', help='Name of the template to use from the configuration.')
+parser.add_argument('--until', help='Get tasks completed on or before this date, in the same formats as --since (e.g., --until 2026-03 includes all of March).')
+parser.add_argument('--tree', default=False, action='store_true', help='If set with --project, shows the project as an outline: tasks nested under their headings, in project order.')
 parser.add_argument('--today', default=False, action='store_true', help='If set will show incomplete tasks in Today.')
+parser.add_argument('--where', help='If provided, only tasks matching this expression are fetched (e.g., \'tag:work and not tag:waiting and deadline<7d\').\nSee README.md for the fields and operators available.')
 
 args = parser.parse_args()
 
 # make sure at least one required argument is provided
-if all(getattr(args, arg) is None or getattr(args, arg) is False for arg in _required_args):
+if all(getattr(args, arg) is None or getattr(args, arg) is False for arg in _required_args) and args.complete is None:
     sys.stderr.write(f"things2md: {_required_args_msg}\nUse --help to learn about available options.\n\n")
     exit(errno.EINVAL) # Invalid argument error code
 
 DEBUG = args.debug
+ARG_AFTER = args.after
+ARG_ARCHIVE = args.archive
+ARG_AREA = args.area
+ARG_AREA_UUID = None # set later if ARG_AREA is provided
+ARG_COMPLETE = args.complete
+ARG_COMPLETION = args.completion
 ARG_DATE = args.date
+ARG_DEADLINE = args.deadline
 ARG_DUE = args.due
 ARG_GROUPBY = args.groupby
+ARG_LIMIT = args.limit
 ARG_ORDERBY = args.orderby
+ARG_OUTPUT_DIR = args.output_dir
 ARG_PROJECT = args.project
 ARG_PROJECTS = args.projects
 ARG_PROJECT_UUID = None # set later if ARG_PROJECT is provided
 ARG_RANGE = args.range
+ARG_REINDEX_VAULT = args.reindex_vault
+ARG_SEARCH = args.search
+ARG_SINCE = args.since
+ARG_SINCE_LAST = args.since_last
+ARG_SINCE_LAST_MARK = None # set later from ARG_SINCE_LAST's state file
+ARG_SNAPSHOT = args.snapshot
+ARG_STATS = args.stats
+ARG_SUBTAGS = args.subtags
 ARG_TAG = args.tag
 ARG_TEMPLATE = args.template
 ARG_TODAY = args.today
+ARG_TREE = args.tree
+ARG_UNTIL = args.until
+ARG_WHERE = args.where
+ARG_WHERE_PREDICATE = None # (SQL, parameters) set later if ARG_WHERE is provided
+ARG_WHERE_ANY_STATUS = False # set later if ARG_WHERE has status or date terms, which match tasks of any status
+
+if ARG_SINCE_LAST and (ARG_AFTER or ARG_PROJECTS or ARG_SEARCH or ARG_STATS is not None or ARG_TREE):
+    sys.stderr.write(f"things2md: --since-last can't be used with --after, --projects, --search, --stats, or --tree\n")
+    exit(errno.EINVAL) # Invalid argument error code
+
+if ARG_AFTER and (ARG_SEARCH or ARG_TREE):
+    sys.stderr.write(f"things2md: --after can't be used with --search or --tree\n")
+    exit(errno.EINVAL) # Invalid argument error code
+
+if ARG_DEADLINE is not None and (ARG_ARCHIVE or ARG_SINCE_LAST):
+    sys.stderr.write(f"things2md: --deadline can't be used with --archive or --since-last\n")
+    exit(errno.EINVAL) # Invalid argument error code
+
+if ARG_TREE and not ARG_PROJECT:
+    sys.stderr.write(f"things2md: --tree requires --project\n")
+    exit(errno.EINVAL) # Invalid argument error code
 
 # #############################################################################
 # LOAD CONFIGURATION
 # #############################################################################
 
-_config_file_path = os.path.join(os.path.dirname(__file__), THINGS2MD_CONFIG_FILE)
-try:
-    with open(_config_file_path, "r") as config_file:
-        CONFIG = json.load(config_file)
-except:
-    sys.stderr.write(f"things2md: Unable to open config file: {THINGS2MD_CONFIG_FILE}\n")
-    exit(1)
-
-_config_error_msg = None
-
-_required_params = ["filters", "formatting", "templates"]
-if any(CONFIG.get(param) is None for param in _required_params):
-    _config_error_msg = f"{THINGS2MD_CONFIG_FILE}: All of these params are required: {', '.join(_required_params)}"
+# compiled configuration is cached here, keyed on the config file's mtime and hash
+THINGS2MD_CONFIG_CACHE_FILE = os.path.join(THINGS2MD_CACHE_DIR, 'config.pickle')
+# full-text search index of tasks, for --search; one per database, named after the database's path hash
+THINGS2MD_SEARCH_INDEX_FILE = os.path.join(THINGS2MD_CACHE_DIR, 'search-{}.sqlite')
+# copy of each database's completed tasks, for --archive; named after the database's path hash
+THINGS2MD_ARCHIVE_FILE = os.path.join(THINGS2MD_CACHE_DIR, 'archive-{}.sqlite')
+# lock file and output shared by concurrent identical runs (see coalesce_invocation); named after the run's key
+THINGS2MD_COALESCE_LOCK_FILE = os.path.join(THINGS2MD_CACHE_DIR, 'coalesce-{}.lock')
+THINGS2MD_COALESCE_RESULT_FILE = os.path.join(THINGS2MD_CACHE_DIR, 'coalesce-{}.pickle')
+THINGS2MD_COALESCE_WAIT_FILE = os.path.join(THINGS2MD_CACHE_DIR, 'coalesce-{}.wait')
+# note names and aliases of the Obsidian vault, for resolving wikilinks; named after the vault's path hash
+THINGS2MD_VAULT_INDEX_FILE = os.path.join(THINGS2MD_CACHE_DIR, 'vault-{}.pickle')
+# output of each task, as last rendered with each template and configuration (see read_render_cache)
+THINGS2MD_RENDER_CACHE_FILE = os.path.join(THINGS2MD_CACHE_DIR, 'render.sqlite')
+# bump whenever the compiled form changes, to invalidate existing caches
+CONFIG_CACHE_VERSION = 5
+
+Config = namedtuple('Config', [
+    # additional Things databases to query (e.g., archived libraries)
+    'databases',
+    # Obsidian vault to resolve wikilinks against, if any
+    'vault',
+    # seconds to wait for Things' locks on its databases (e.g., while it syncs), if not SQLite's default
+    'busy_timeout',
+    # filters
+    'remove_area_emojis', 'remove_heading_emojis', 'remove_project_emojis', 'remove_task_emojis',
+    'remove_empty_checklist_items', 'skip_tags', 'skip_subtags',
+    # formatting
+    'area_sep', 'date_sep', 'deadline_sep', 'heading_sep', 'project_sep', 'status_symbols',
+    # templates, by name; and any validation error for each template, by name
+    'templates', 'template_errors'])
+
+def compile_config(config):
+    '''
+    Validates the given configuration (as loaded from JSON) and compiles it into a dict of Config fields.
+    Returns the compiled fields, and an error message if the configuration is invalid.
+    '''
+    _required_params = ["filters", "formatting", "templates"]
+    if any(config.get(param) is None for param in _required_params):
+        return None, f"{THINGS2MD_CONFIG_FILE}: All of these params are required: {', '.join(_required_params)}"
 
-if _cfg_filters := CONFIG.get("filters"):
+    cfg_filters = config.get("filters")
     _required_params = ["remove_area_emojis", "remove_heading_emojis", "remove_project_emojis", "remove_task_emojis", "skip_tags"]
-    if any(_cfg_filters.get(param) is None for param in _required_params):
-        _config_error_msg = f"{THINGS2MD_CONFIG_FILE} (filters): All of these params are required: {', '.join(_required_params)}"
-    CFG_REMOVE_AREA_EMOJIS = _cfg_filters.get("remove_area_emojis")
-    CFG_REMOVE_HEADING_EMOJIS = _cfg_filters.get("remove_heading_emojis")
-    CFG_REMOVE_PROJECT_EMOJIS = _cfg_filters.get("remove_project_emojis")
-    CFG_REMOVE_TASK_EMOJIS = _cfg_filters.get("remove_task_emojis")
-    CFG_REMOVE_EMPTY_CHECKLIST_ITEMS = _cfg_filters.get("remove_empty_checklist_items") if _cfg_filters.get("remove_empty_checklist_items") else False
-    CFG_SKIP_TAGS = _cfg_filters.get("skip_tags")
-
-if _cfg_formatting := CONFIG.get("formatting"):
+    if any(cfg_filters.get(param) is None for param in _required_params):
+        return None, f"{THINGS2MD_CONFIG_FILE} (filters): All of these params are required: {', '.join(_required_params)}"
+
+    cfg_formatting = config.get("formatting")
     _required_params = ["area_sep", "date_sep", "deadline_sep", "heading_sep", "project_sep", "status_symbols"]
-    if any(_cfg_formatting.get(param) is None for param in _required_params):
-        _config_error_msg = f"{THINGS2MD_CONFIG_FILE} (formatting): All of these params are required: {', '.join(_required_params)}"
-    CFG_AREA_SEPARATOR = _cfg_formatting.get("area_sep")
-    CFG_DATE_SEPARATOR = _cfg_formatting.get("date_sep")
-    CFG_DEADLINE_SEPARATOR = _cfg_formatting.get("deadline_sep")
-    CFG_HEADING_SEPARATOR = _cfg_formatting.get("heading_sep")
-    CFG_PROJECT_SEPARATOR = _cfg_formatting.get("project_sep")
-    CFG_STATUS_SYMBOLS = _cfg_formatting.get("status_symbols")
- 
-if _cfg_templates := CONFIG.get("templates"):
-    # get the requested template
-    CFG_TEMPLATE = None
-    for template in _cfg_templates:
-        if template.get("name") == ARG_TEMPLATE:
-            CFG_TEMPLATE = template
-            break
-    if not CFG_TEMPLATE:
-        _config_error_msg = f"Unable to find template: {ARG_TEMPLATE}\n"
-    else:
-        # validate the provided template's params are set
-        if CFG_TEMPLATE.get('type') == 'markdown_note':
+    if any(cfg_formatting.get(param) is None for param in _required_params):
+        return None, f"{THINGS2MD_CONFIG_FILE} (formatting): All of these params are required: {', '.join(_required_params)}"
+
+    # validate each template's params are set; errors are only reported if that template is used
+    templates = {}
+    template_errors = {}
+    for template in config.get("templates"):
+        name = template.get("name")
+        if name in templates:
+            continue # the first template with a given name wins
+        if template.get('type') == 'markdown_note':
             _required_params = ["title", "body", "checklist_item"]
         else:
             _required_params = ["checklist_item", "groupby_date", "groupby_project", "project", "notes", "task"]
-        if any(CFG_TEMPLATE.get(param) is None for param in _required_params):
-            _config_error_msg = f"{THINGS2MD_CONFIG_FILE} ({ARG_TEMPLATE}): All of these params are required: {', '.join(_required_params)}"
+        if any(template.get(param) is None for param in _required_params):
+            template_errors[name] = f"{THINGS2MD_CONFIG_FILE} ({name}): All of these params are required: {', '.join(_required_params)}"
+        templates[name] = template
         # TODO: for ease-of-use, replace all template variables with lower-case?
 
-if _config_error_msg:
-    sys.stderr.write(f"things2md: {_config_error_msg}")
+    databases = config.get("databases") or []
+    if not isinstance(databases, list) or not all(isinstance(path, str) for path in databases):
+        return None, f"{THINGS2MD_CONFIG_FILE}: databases must be a list of paths"
+
+    vault = config.get("vault")
+    if vault is not None and not isinstance(vault, str):
+        return None, f"{THINGS2MD_CONFIG_FILE}: vault must be a path"
+
+    busy_timeout = config.get("busy_timeout")
+    if busy_timeout is not None and (not isinstance(busy_timeout, (int, float)) or isinstance(busy_timeout, bool) or busy_timeout < 0):
+        return None, f"{THINGS2MD_CONFIG_FILE}: busy_timeout must be a number of seconds"
+
+    return dict(
+        databases=tuple(os.path.expanduser(path) for path in databases),
+        vault=os.path.expanduser(vault) if vault else None,
+        busy_timeout=busy_timeout,
+        remove_area_emojis=cfg_filters.get("remove_area_emojis"),
+        remove_heading_emojis=cfg_filters.get("remove_heading_emojis"),
+        remove_project_emojis=cfg_filters.get("remove_project_emojis"),
+        remove_task_emojis=cfg_filters.get("remove_task_emojis"),
+        remove_empty_checklist_items=cfg_filters.get("remove_empty_checklist_items") or False,
+        skip_tags=frozenset(cfg_filters.get("skip_tags")),
+        skip_subtags=cfg_filters.get("skip_subtags") or False,
+        area_sep=cfg_formatting.get("area_sep"),
+        date_sep=cfg_formatting.get("date_sep"),
+        deadline_sep=cfg_formatting.get("deadline_sep"),
+        heading_sep=cfg_formatting.get("heading_sep"),
+        project_sep=cfg_formatting.get("project_sep"),
+        status_symbols=dict(cfg_formatting.get("status_symbols")),
+        templates=templates,
+        template_errors=template_errors), None
+
+def load_config(config_file_path, cache_file_path):
+    '''
+    Returns the compiled Config for the given config file, from the on-disk cache if the config
+    file hasn't changed (same mtime, or else same contents hash), otherwise by compiling it.
+    '''
+    try:
+        config_stat = os.stat(config_file_path)
+    except OSError:
+        sys.stderr.write(f"things2md: Unable to open config file: {THINGS2MD_CONFIG_FILE}\n")
+        exit(1)
+
+    cached = None
+    try:
+        with open(cache_file_path, "rb") as cache_file:
+            cached = pickle.load(cache_file)
+        if cached.get('version') != CONFIG_CACHE_VERSION:
+            cached = None
+    except Exception:
+        cached = None
+
+    fields = None
+    if cached and cached['mtime_ns'] == config_stat.st_mtime_ns and cached['size'] == config_stat.st_size:
+        fields = cached['config']
+    else:
+        try:
+            with open(config_file_path, "rb") as config_file:
+                config_bytes = config_file.read()
+            config_hash = hashlib.sha256(config_bytes).hexdigest()
+            if cached and cached['hash'] == config_hash:
+                fields = cached['config']
+            else:
+                fields, config_error_msg = compile_config(json.loads(config_bytes))
+                if config_error_msg:
+                    sys.stderr.write(f"things2md: {config_error_msg}")
+                    exit(1)
+        except (OSError, ValueError, AttributeError, TypeError):
+            sys.stderr.write(f"things2md: Unable to open config file: {THINGS2MD_CONFIG_FILE}\n")
+            exit(1)
+        write_cache_file(cache_file_path, dict(version=CONFIG_CACHE_VERSION, mtime_ns=config_stat.st_mtime_ns,
+                                               size=config_stat.st_size, hash=config_hash, config=fields))
+
+    # freeze the compiled config
+    fields = dict(fields)
+    fields['status_symbols'] = MappingProxyType(fields['status_symbols'])
+    fields['templates'] = MappingProxyType({name: MappingProxyType(template) for name, template in fields['templates'].items()})
+    fields['template_errors'] = MappingProxyType(fields['template_errors'])
+    return Config(**fields)
+
+def write_cache_file(cache_file_path, data):
+    '''
+    Atomically writes the given data to a cache file. Caches are optional, so failures are ignored.
+    '''
+    try:
+        os.makedirs(os.path.dirname(cache_file_path), exist_ok=True)
+        temp_file_path = f"{cache_file_path}.{os.getpid()}.tmp"
+        with open(temp_file_path, "wb") as cache_file:
+            pickle.dump(data, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_file_path, cache_file_path)
+    except OSError:
+        pass
+
+CONFIG = load_config(os.path.join(os.path.dirname(__file__), THINGS2MD_CONFIG_FILE),
+                     os.path.join(os.path.dirname(__file__), THINGS2MD_CONFIG_CACHE_FILE))
+
+# get the requested template
+CFG_TEMPLATE = CONFIG.templates.get(ARG_TEMPLATE)
+if CFG_TEMPLATE is None:
+    sys.stderr.write(f"things2md: Unable to find template: {ARG_TEMPLATE}\n")
+    exit(1)
+if ARG_TEMPLATE in CONFIG.template_errors:
+    sys.stderr.write(f"things2md: {CONFIG.template_errors[ARG_TEMPLATE]}")
     exit(1)
 
 # #############################################################################
@@ -147,17 +385,709 @@ event_start_rfc5545 = event_start_time.strftime('%Y%m%dT%H%M%S')
 event_finish_rfc5545 = event_finish_time.strftime('%Y%m%dT%H%M%S')
 GCAL_EVENT_DATES = f"{event_start_rfc5545}/{event_finish_rfc5545}"
 
-QUERY_LIMIT = 100
+# SQL sort keys for task queries, as (columns, direction); the task uuid is
+# always the last column so that every key uniquely identifies a row, which
+# lets pages continue from a cursor (keyset pagination)
+TASK_SORT_KEYS = {
+    'date': (['TASK.stopDate', 'TASK.uuid'], 'DESC'),
+    'deadline': (['TASK.deadline', 'TASK."index"', 'TASK.uuid'], 'ASC'),
+    'index': (['TASK."index"', 'TASK.uuid'], 'ASC'),
+    'todayIndex': (['TASK.todayIndex', 'TASK.uuid'], 'ASC'),
+}
+
+# the same sort keys, computed from fetched tasks, for merging the tasks of several databases
+TASK_MERGE_KEYS = {
+    'date': lambda task: (task.get('stop_date', 0), task['uuid']),
+    'deadline': lambda task: (task.get('deadline', 0), task.get('index', 0), task['uuid']),
+    'index': lambda task: (task.get('index', 0), task['uuid']),
+    'todayIndex': lambda task: (task.get('today_index', 0), task['uuid']),
+}
+
+# composite sort keys for --orderby values that are ordered in Python rather than by the query;
+# like TASK_SORT_KEYS, each ends with the uuid, so that pages can continue from a cursor
+TASK_ORDER_KEYS = {
+    'area': lambda task: (get_area_title(task).casefold(), -task.get('stop_date', float('-inf')), task['uuid']),
+    'project': lambda task: ((task.get('project_title') or task.get('heading_project_title', "")).casefold(),
+                             -task.get('stop_date', float('-inf')), task['uuid']),
+}
+PROJECT_ORDER_KEYS = {
+    'area': lambda project: (project.get('area_title', "").casefold(), project['uuid']),
+    'project': lambda project: (project['title'].casefold(), project['uuid']),
+}
+
+# the query for tasks and projects, given the WHERE and ORDER BY predicates. Columns mirror those of
+# things.py's tasks, except that dates are left as numbers: stop dates as UTC timestamps, and deadlines as
+# Things' packed dates (see format_things_date); they're only formatted when output. Tags and checklists
+# are flagged by uncorrelated subqueries (evaluated once), rather than joined, so rows needn't be made DISTINCT
+TASKS_SQL = """
+    SELECT
+        TASK.uuid,
+        CASE
+            WHEN TASK.type = 0 THEN 'to-do'
+            WHEN TASK.type = 1 THEN 'project'
+            WHEN TASK.type = 2 THEN 'heading'
+        END AS type,
+        TASK.title,
+        CASE
+            WHEN TASK.status = 0 THEN 'incomplete'
+            WHEN TASK.status = 2 THEN 'canceled'
+            WHEN TASK.status = 3 THEN 'completed'
+        END AS status,
+        AREA.uuid AS area,
+        AREA.title AS area_title,
+        PROJECT.uuid AS project,
+        PROJECT.title AS project_title,
+        HEADING.uuid AS heading,
+        HEADING.title AS heading_title,
+        TASK.notes,
+        CASE WHEN TASK.uuid IN (SELECT TASK_TAG.tasks FROM TMTaskTag AS TASK_TAG) THEN 1 END AS tags,
+        CASE WHEN TASK.uuid IN (SELECT CHECKLIST_ITEM.task FROM TMChecklistItem AS CHECKLIST_ITEM) THEN 1 END AS checklist,
+        TASK.deadline,
+        TASK.stopDate AS stop_date,
+        TASK."index",
+        TASK.todayIndex AS today_index,
+        TASK.userModificationDate AS modified
+    FROM
+        TMTask AS TASK
+    LEFT OUTER JOIN
+        TMTask PROJECT ON TASK.project = PROJECT.uuid
+    LEFT OUTER JOIN
+        TMArea AREA ON TASK.area = AREA.uuid
+    LEFT OUTER JOIN
+        TMTask HEADING ON TASK.heading = HEADING.uuid
+    LEFT OUTER JOIN
+        TMTask PROJECT_OF_HEADING ON HEADING.project = PROJECT_OF_HEADING.uuid
+    WHERE
+        {where_predicate}
+    ORDER BY
+        {order_predicate}
+    """
+
+# --stats dimensions: the SQL for each group's key, and any joins it needs
+STATS_DIMENSIONS = {
+    'day': ("date(TASK.stopDate, 'unixepoch', 'localtime')", ""),
+    'project': ("COALESCE(PROJECT.title, PROJECT_OF_HEADING.title)", ""),
+    'area': ("COALESCE(AREA.title, PROJECT_AREA.title)",
+             "LEFT OUTER JOIN TMArea PROJECT_AREA ON PROJECT_AREA.uuid = COALESCE(PROJECT.area, PROJECT_OF_HEADING.area)"),
+    'tag': ("TAG.title", "JOIN TMTaskTag TASK_TAG ON TASK_TAG.tasks = TASK.uuid JOIN TMTag TAG ON TAG.uuid = TASK_TAG.tags"),
+}
+
+# hashes of the files written by --output-dir, kept in the output directory
+THINGS2MD_MANIFEST_FILE = '.things2md_manifest.json'
+# characters not allowed in file names (across macOS, Windows, and Obsidian links)
+FILENAME_PATTERN = re.compile(r'[\x00-\x1f\\/:*?"<>|#^\[\]]+')
+
+# wikilinks in rendered output, as [[target]], [[target#section]], or [[target|display text]]
+WIKILINK_PATTERN = re.compile(r'\[\[([^\[\]|#]*)(#[^\[\]|]*)?(?:\|([^\[\]]*))?\]\]')
+# bump whenever the vault index's form changes, to rebuild existing indexes
+VAULT_INDEX_VERSION = 1
+
+# --where tokens: parentheses, terms (a field, operator, and value, which may be quoted), and keywords (and, or, not)
+WHERE_TOKEN_PATTERN = re.compile(r'\s*(?:([()])|(\w+)\s*(<=|>=|!=|[:~<>=])\s*("(?:[^"\\]|\\.)*"|[^\s()"]+)|(\w+)|(\S))')
+# --where fields compared as text, and the SQL for each
+WHERE_TEXT_FIELDS = {
+    'area': "(SELECT WHERE_AREA.title FROM TMArea AS WHERE_AREA WHERE WHERE_AREA.uuid = COALESCE(TASK.area, PROJECT.area, PROJECT_OF_HEADING.area))",
+    'heading': "HEADING.title",
+    'notes': "TASK.notes",
+    'project': "COALESCE(PROJECT.title, PROJECT_OF_HEADING.title)",
+    'title': "TASK.title",
+}
+# --where has: values, and the SQL for each
+WHERE_HAS_FIELDS = {
+    'area': "COALESCE(TASK.area, PROJECT.area, PROJECT_OF_HEADING.area) IS NOT NULL",
+    'checklist': "TASK.uuid IN (SELECT CHECKLIST_ITEM.task FROM TMChecklistItem AS CHECKLIST_ITEM)",
+    'deadline': "TASK.deadline IS NOT NULL",
+    'heading': "TASK.heading IS NOT NULL",
+    'notes': "IFNULL(TASK.notes, '') != ''",
+    'project': "COALESCE(TASK.project, PROJECT_OF_HEADING.uuid) IS NOT NULL",
+    'tags': "TASK.uuid IN (SELECT TASK_TAG.tasks FROM TMTaskTag AS TASK_TAG)",
+}
+# --where status: and type: values, as stored by Things
+WHERE_STATUSES = {'incomplete': 0, 'canceled': 2, 'completed': 3}
+WHERE_TYPES = {'to-do': 0, 'task': 0, 'project': 1}
+
+# maximum number of SQL parameters used in a single IN (...) list
+SQL_IN_CHUNK_SIZE = 500
+
+# connections to the Things databases, opened by each thread on first use; see get_database()
+DATABASES = threading.local()
+
+# scripts output by --completion, given the commands to run things2md ({command}) and to complete names with it
+# ({complete_command}), its options ({options}), and those that take names ({name_options})
+COMPLETION_SCRIPTS = {
+    'bash': '''
+things2md() { {command} "$@"; }
+_things2md() {
+    local cur="${COMP_WORDS[COMP_CWORD]}" prev="${COMP_WORDS[COMP_CWORD-1]}" names name
+    COMPREPLY=()
+    case "$prev" in
+        {name_options}) ;;
+        *) COMPREPLY=($(compgen -W "{options}" -- "$cur")); return ;;
+    esac
+    cur="${cur#[\\"\\']}"
+    names="$({complete_command} --complete "${prev#--}" "$cur" 2>/dev/null)"
+    [ -n "$names" ] || return
+    while IFS= read -r name; do
+        COMPREPLY+=("$(printf '%q' "$name")")
+    done <<< "$names"
+}
+complete -F _things2md things2md
+''',
+    'zsh': '''
+things2md() { {command} "$@"; }
+_things2md() {
+    local -a names
+    case "${words[CURRENT-1]}" in
+        {name_options}) ;;
+        *) compadd -- {options}; return ;;
+    esac
+    names=(${(f)"$({complete_command} --complete "${words[CURRENT-1]#--}" "${(Q)PREFIX}" 2>/dev/null)"})
+    compadd -U -- $names
+}
+compdef _things2md things2md
+''',
+}
+
+# tables copied to archives (with the same schema as the database's), and the archives' indexes
+ARCHIVE_TABLES = ["Meta", "TMArea", "TMAreaTag", "TMChecklistItem", "TMTag", "TMTask", "TMTaskTag"]
+ARCHIVE_INDEXES_SQL = '''
+    CREATE INDEX IF NOT EXISTS archive_task_stop_date ON TMTask (stopDate);
+    CREATE INDEX IF NOT EXISTS archive_task_project ON TMTask (project);
+    CREATE INDEX IF NOT EXISTS archive_task_heading ON TMTask (heading);
+    CREATE INDEX IF NOT EXISTS archive_task_tag_tag ON TMTaskTag (tags, tasks);
+    CREATE INDEX IF NOT EXISTS archive_task_tag_task ON TMTaskTag (tasks);
+    CREATE INDEX IF NOT EXISTS archive_checklist_item_task ON TMChecklistItem (task);
+    '''
+# seconds to wait for a concurrent identical run to finish, before running anyway; see coalesce_invocation()
+COALESCE_TIMEOUT = 5
+# this run's lock file, and where to share its output, if it's the one concurrent identical runs wait on
+COALESCE = None
+
+# time (per time.monotonic) by which queries are interrupted, if --deadline is set; see check_deadline()
+DEADLINE = None
+# number of SQLite virtual machine instructions between checks of the deadline
+DEADLINE_CHECK_INTERVAL = 10000
+# set once the task query is interrupted by the deadline, so that the tasks output are only those fetched by then
+DEADLINE_REACHED = False
+# taken by the first thread to give up on its queries at the deadline, so that only it outputs anything
+DEADLINE_LOCK = threading.Lock()
+
+# most task outputs kept in the render cache, beyond which the least recently used are evicted; and how often (in
+# seconds) outputs reused are marked as used, so that reusing them doesn't mean rewriting them on every run
+RENDER_CACHE_SIZE = 100000
+RENDER_CACHE_TOUCH_INTERVAL = 24 * 60 * 60
+# bump whenever tasks' output changes (other than by their template or configuration), to re-render cached tasks
+RENDER_CACHE_VERSION = 2
+
+# database path -> path of its snapshot, if --snapshot is set; taken once per run, before any queries, so that
+# all of them read the same copy of each database (see get_snapshot)
+SNAPSHOTS = {}
+
+# database path -> path of its archive, for databases whose archive covers the dates requested; see get_database_filepaths()
+ARCHIVES = {}
+
+TAG_CHILDREN = None # tag title -> titles of its child tags, in all databases; see get_tag_children()
+SKIP_TAGS = None # skip_tags, with their descendants if skip_subtags is set; see get_skip_tags()
 
 TODAY = datetime.today().astimezone()
 TODAY_DATE = TODAY.date()
 TODAY_INT = int(TODAY_DATE.strftime('%Y%m%d'))
 TODAY_TIMESTAMP = datetime(TODAY.year, TODAY.month, TODAY.day).timestamp()
 
+# #############################################################################
+# RECORDS
+# #############################################################################
+
+class Task:
+    '''
+    A task or project, as fetched by fetch_tasks(). Fields are slots rather than dict keys, and values
+    repeated across tasks (e.g., statuses, and uuids and titles of projects and areas) are interned, to keep
+    large results small. Supports the parts of the dict interface the script uses; as with things.py's
+    dicts, fields without a value (None) aren't `in` a task.
+    '''
+    __slots__ = ('uuid', 'type', 'title', 'status', 'area', 'area_title', 'project', 'project_title',
+                 'heading', 'heading_title', 'heading_project', 'heading_project_title', 'notes', 'tags',
+                 'checklist', 'deadline', 'stop_date', 'index', 'today_index', 'modified', 'database')
+    INTERNED_FIELDS = frozenset(['type', 'status', 'area', 'area_title', 'project', 'project_title',
+                                 'heading', 'heading_title', 'heading_project', 'heading_project_title'])
+
+    def __init__(self, **fields):
+        for field in self.__slots__:
+            value = fields.get(field)
+            if field in self.INTERNED_FIELDS and value is not None:
+                value = sys.intern(value)
+            setattr(self, field, value)
+
+    @classmethod
+    def row_factory(cls, cursor, row):
+        '''
+        SQLite row factory that makes a Task of each row, without an intermediate dict.
+        '''
+        return cls(**{column[0]: value for column, value in zip(cursor.description, row) if column[0] in cls.__slots__})
+
+    def __contains__(self, field):
+        return getattr(self, field, None) is not None
+
+    def __getitem__(self, field):
+        if field not in self.__slots__:
+            raise KeyError(field)
+        return getattr(self, field)
+
+    def __setitem__(self, field, value):
+        setattr(self, field, value)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def get(self, field, default=None):
+        value = getattr(self, field, None)
+        return default if value is None else value
+
+    def keys(self):
+        return [field for field in self.__slots__ if getattr(self, field) is not None]
+
+class TeeStream:
+    '''
+    An output stream (e.g., stdout) that also keeps everything written to it, so that it can be shared with
+    concurrent identical runs (see coalesce_invocation).
+    '''
+    def __init__(self, stream):
+        self.stream = stream
+        self.output = io.StringIO()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    def write(self, string):
+        self.output.write(string)
+        return self.stream.write(string)
+
 # #############################################################################
 # FUNCTIONS
 # #############################################################################
 
+def build_tree(rows, headings):
+    '''
+    Builds the outline of a project from its (template variables, markdown) rows and its headings,
+    in a single pass over the rows. Rows keep their order within each heading.
+    Returns the rows not under a heading, and a list of (heading, rows) for each heading with rows.
+    '''
+    heading_rows = {heading['uuid']: [] for heading in headings}
+    root_rows = []
+    for row in rows:
+        heading_rows.get(row[0].get('heading_uuid'), root_rows).append(row)
+    return root_rows, [(heading, heading_rows[heading['uuid']]) for heading in headings if heading_rows[heading['uuid']]]
+
+def check_deadline():
+    '''
+    SQLite progress handler that interrupts queries once the --deadline has passed.
+    '''
+    return time.monotonic() >= DEADLINE
+
+def close_databases():
+    '''
+    Closes this thread's connections to the databases, which are reopened on next use.
+    '''
+    for database in DATABASES.__dict__.pop('connections', {}).values():
+        database.connection.close()
+
+def coalesce_invocation(invocation_key):
+    '''
+    Coordinates concurrent runs with the given key (see get_invocation_key) through a lock file, so that only one
+    of them queries Things: the first to take the lock does the work, keeping its output to share once it succeeds
+    (see write_coalesced_result). Runs started while it holds the lock wait for it, then output the same, and exit;
+    they leave a wait file, so that it's only shared when there's a run waiting for it. A run waits for up to
+    COALESCE_TIMEOUT seconds, and does the work itself if it took longer, or if the one it waited on failed.
+    '''
+    global COALESCE
+    lock_file_path = os.path.join(os.path.dirname(__file__), THINGS2MD_COALESCE_LOCK_FILE.format(invocation_key))
+    result_file_path = os.path.join(os.path.dirname(__file__), THINGS2MD_COALESCE_RESULT_FILE.format(invocation_key))
+    wait_file_path = os.path.join(os.path.dirname(__file__), THINGS2MD_COALESCE_WAIT_FILE.format(invocation_key))
+    started_at = time.time()
+    try:
+        os.makedirs(os.path.dirname(lock_file_path), exist_ok=True)
+        lock_file = open(lock_file_path, "w")
+    except OSError:
+        return # coalescing is optional
+
+    waited = False
+    while True:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            break
+        except BlockingIOError:
+            if DEADLINE is not None and time.monotonic() >= DEADLINE:
+                exit_with_cached_output()
+            if time.time() - started_at >= COALESCE_TIMEOUT:
+                lock_file.close()
+                return
+            if not waited:
+                try:
+                    open(wait_file_path, "w").close()
+                except OSError:
+                    pass # then this run may wait in vain, and do the work itself
+            waited = True
+            time.sleep(0.02)
+
+    if waited:
+        # only output from a run that finished after this one started is shared
+        try:
+            with open(result_file_path, "rb") as result_file:
+                result = pickle.load(result_file)
+        except Exception:
+            result = None
+        if result and result['finished_at'] >= started_at:
+            sys.stdout.write(result['stdout'])
+            sys.stderr.write(result['stderr'])
+            exit(0)
+
+    # the lock is held until this run exits
+    COALESCE = dict(lock_file=lock_file, result_file_path=result_file_path, wait_file_path=wait_file_path)
+    sys.stdout = TeeStream(sys.stdout)
+    sys.stderr = TeeStream(sys.stderr)
+
+def compile_where(expression):
+    '''
+    Compiles the given --where expression into a SQL predicate on the task query's tables (and its parameters),
+    so that only matching tasks are fetched. Expressions are terms (see compile_where_term) combined with
+    `and`, `or`, `not`, and parentheses (e.g., tag:work and not (tag:waiting or deadline<7d)).
+    Also returns whether the expression has status or date terms, so that it isn't limited to uncompleted tasks.
+    '''
+    tokens = [] # (keyword or parenthesis, or None for a term; and the term's field, operator, and value)
+    for match in WHERE_TOKEN_PATTERN.finditer(expression):
+        parenthesis, field, operator, value, keyword, invalid = match.groups()
+        if invalid or (keyword and keyword.lower() not in ("and", "or", "not")):
+            sys.stderr.write(f"things2md: Invalid --where expression: expected a term (e.g., tag:work) at: {invalid or keyword}\n")
+            exit(errno.EINVAL) # Invalid argument error code
+        if value and value.startswith('"'):
+            value = re.sub(r'\\(.)', r'\1', value[1:-1])
+        tokens.append((parenthesis or (keyword and keyword.lower()), (field, operator, value)))
+    position = 0
+    fields = set()
+
+    def parse(precedence):
+        # precedence 0 parses `or`, 1 parses `and`, and 2 parses `not`, parentheses, and terms
+        nonlocal position
+        if precedence < 2:
+            sql, parameters = parse(precedence + 1)
+            keyword = ("or", "and")[precedence]
+            while position < len(tokens) and tokens[position][0] == keyword:
+                position += 1
+                right_sql, right_parameters = parse(precedence + 1)
+                sql, parameters = f"({sql} {keyword.upper()} {right_sql})", parameters + right_parameters
+            return sql, parameters
+        if position >= len(tokens):
+            raise ValueError("unexpected end of expression")
+        token, term = tokens[position]
+        position += 1
+        if token == "not":
+            sql, parameters = parse(2)
+            return f"NOT {sql}", parameters
+        if token == "(":
+            sql, parameters = parse(0)
+            if position >= len(tokens) or tokens[position][0] != ")":
+                raise ValueError("missing )")
+            position += 1
+            return sql, parameters
+        if token:
+            raise ValueError(f"unexpected: {token}")
+        fields.add(term[0].lower())
+        return compile_where_term(*term)
+
+    try:
+        sql, parameters = parse(0)
+        if position < len(tokens):
+            raise ValueError(f"expected and/or before: {tokens[position][0] or ''.join(tokens[position][1])}")
+    except ValueError as e:
+        sys.stderr.write(f"things2md: Invalid --where expression: {e}\n")
+        exit(errno.EINVAL) # Invalid argument error code
+    return sql, parameters, bool(fields & {"status", "date"})
+
+def compile_where_term(field, operator, value):
+    '''
+    Compiles a --where term (e.g., tag:work, project~"Client", deadline<7d, has:notes) into a SQL predicate,
+    and its parameters. Raises a ValueError if the term is invalid.
+    Text is compared ignoring case, as a whole (`:` or `=`, and `!=`), or as containing the value (`~`).
+    SQLite only ignores the case of ASCII letters, so non-ASCII values are compared in Python (see match_text).
+    Predicates are never NULL, so that `not` also matches tasks without the field (e.g., without a project).
+    '''
+    field = field.lower()
+    if operator == "=":
+        operator = ":"
+
+    if field in WHERE_TEXT_FIELDS and operator in (":", "!=", "~"):
+        column = f"IFNULL({WHERE_TEXT_FIELDS[field]}, '')"
+        if value.isascii():
+            pattern = value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            sql = f"{column} LIKE ? ESCAPE '\\'"
+            parameters = [f"%{pattern}%" if operator == "~" else pattern]
+        else:
+            sql = f"things2md_match_text({column}, ?, ?)"
+            parameters = [operator, value.casefold()]
+        return (f"NOT {sql}" if operator == "!=" else sql), parameters
+
+    if field == "tag" and operator in (":", "!="):
+        if value not in get_tag_children():
+            raise ValueError(f"tag not found: {value}")
+        tags = sorted(get_tags_with_descendants([value])) if ARG_SUBTAGS else [value]
+        sql = f"""TASK.uuid IN (
+            SELECT TASK_TAG.tasks FROM TMTaskTag AS TASK_TAG JOIN TMTag AS TAG ON TAG.uuid = TASK_TAG.tags
+            WHERE TAG.title IN ({", ".join("?" * len(tags))}))"""
+        return (f"NOT {sql}" if operator == "!=" else sql), tags
+
+    if field == "has" and operator == ":" and value.lower() in WHERE_HAS_FIELDS:
+        return WHERE_HAS_FIELDS[value.lower()], []
+
+    if field in ("status", "type") and operator in (":", "!="):
+        values = WHERE_STATUSES if field == "status" else WHERE_TYPES
+        if value.lower() not in values:
+            raise ValueError(f"{field} must be one of: {', '.join(values)}")
+        return f"TASK.{field} {'=' if operator == ':' else '!='} ?", [values[value.lower()]]
+
+    if field in ("date", "deadline") and operator in (":", "!=", "<", "<=", ">", ">="):
+        day = get_where_date(value)
+        if field == "date":
+            # stop dates are UTC timestamps, so compare with the timestamps of the (local) day's bounds
+            column = "TASK.stopDate"
+            first, last = (datetime(bound.year, bound.month, bound.day).timestamp() for bound in (day, day + relativedelta(days=1)))
+        else:
+            # deadlines are packed dates (see format_things_date), which are ordered as the dates are
+            column = "TASK.deadline"
+            first = (day.year << 16) | (day.month << 12) | (day.day << 7)
+            last = first + 1
+        return {
+            ":": (f"IFNULL({column} >= ? AND {column} < ?, 0)", [first, last]),
+            "!=": (f"IFNULL({column} < ? OR {column} >= ?, 1)", [first, last]),
+            "<": (f"IFNULL({column} < ?, 0)", [first]),
+            "<=": (f"IFNULL({column} < ?, 0)", [last]),
+            ">": (f"IFNULL({column} >= ?, 0)", [last]),
+            ">=": (f"IFNULL({column} >= ?, 0)", [first]),
+        }[operator]
+
+    raise ValueError(f"unknown term: {field}{operator}{value}")
+
+def exit_with_cached_output(error=None):
+    '''
+    Exits when the --deadline is reached (or Things' locks were waited on for too long) before any tasks were
+    fetched: outputting the last complete output of this command with a --deadline instead (see write_coalesced_result),
+    if it was today. Only the first thread to give up outputs anything.
+    '''
+    if error is not None:
+        # release the connections referenced by the failed query's frames in this thread, as they can't be closed in others
+        traceback.clear_frames(error.__traceback__)
+    if DEADLINE_LOCK.acquire(blocking=False):
+        reason = f"Deadline of {ARG_DEADLINE:g} seconds reached" if time.monotonic() >= DEADLINE else f"Things database is busy ({error})"
+        result_file_path = os.path.join(os.path.dirname(__file__), THINGS2MD_COALESCE_RESULT_FILE.format(invocation_key))
+        try:
+            with open(result_file_path, "rb") as result_file:
+                result = pickle.load(result_file)
+        except Exception:
+            result = None
+        if result:
+            sys.stdout.write(result['stdout'])
+            sys.stderr.write(result['stderr'])
+            sys.stderr.write(f"things2md: {reason}; output is from {datetime.fromtimestamp(result['finished_at']):%H:%M:%S}\n")
+        else:
+            sys.stderr.write(f"things2md: {reason}; no results were fetched\n")
+    exit(errno.ETIMEDOUT)
+
+def fetch_tasks(where_predicates, parameters, sort_key, after_key=None, limit=None, partial=False):
+    '''
+    Fetches tasks matching the given SQL predicates from this thread's database, ordered by the given key
+    in TASK_SORT_KEYS. Results are paged by keyset: `after_key` is the sort key of the last task on the
+    previous page (see get_cursor_key), so fetching a page costs the same no matter how deep into the results it is.
+    If `partial` is set, and the query is interrupted by the --deadline, the tasks fetched by then are returned.
+    Returns the tasks, and the cursor for the next page (or None if this is the last page).
+    '''
+    global DEADLINE_REACHED
+    database = get_database()
+    columns, direction = TASK_SORT_KEYS[sort_key]
+    where_predicates = list(where_predicates)
+    parameters = list(parameters)
+
+    if after_key:
+        # compared as a row value, so that the sort key's index can be used
+        comparator = "<" if direction == "DESC" else ">"
+        where_predicates.append(f"AND ({', '.join(columns)}) {comparator} ({', '.join('?' * len(columns))})")
+        parameters += after_key
+
+    sql_query = TASKS_SQL.format(where_predicate="\n".join(where_predicates),
+                                 order_predicate=", ".join(f"{column} {direction}" for column in columns))
+    if limit:
+        # fetch one extra row to find out if there's another page
+        sql_query += "LIMIT ?"
+        parameters.append(limit + 1)
+
+    interrupted = False
+    if partial and DEADLINE is not None:
+        # fetched in batches, so that those fetched by the deadline can be output
+        tasks = []
+        cursor = database.connection.cursor()
+        cursor.row_factory = Task.row_factory
+        try:
+            cursor.execute(sql_query, parameters)
+            while batch := cursor.fetchmany(1000):
+                tasks += batch
+        except sqlite3.OperationalError as e:
+            if e.sqlite_errorcode != sqlite3.SQLITE_INTERRUPT:
+                raise
+            interrupted = DEADLINE_REACHED = True
+            if DEBUG: print(f"\nDEADLINE: {len(tasks)} tasks fetched")
+    else:
+        tasks = database.execute_query(sql_query, parameters, row_factory=Task.row_factory)
+
+    next_cursor = None
+    if limit and len(tasks) > limit:
+        tasks = tasks[:limit]
+        next_cursor = tasks[-1]['uuid']
+
+    # the tags and checklists of tasks fetched by the deadline are still fetched (by uuid, so quickly)
+    if interrupted: database.connection.set_progress_handler(None, 0)
+    include_task_items(tasks)
+    if interrupted: database.connection.set_progress_handler(check_deadline, DEADLINE_CHECK_INTERVAL)
+    # remember where each task came from, for later lookups (e.g., of its heading)
+    database_file_path = get_database_filepath()
+    for task in tasks:
+        task.database = database_file_path
+
+    return tasks, next_cursor
+
+def format_date(timestamp):
+    '''
+    Returns the local date of the given (UTC) timestamp, in ISO format (e.g., 2024-03-06).
+    '''
+    return datetime.fromtimestamp(timestamp).date().isoformat()
+
+def format_things_date(things_date):
+    '''
+    Returns the given date, packed as Things stores it (e.g., for deadlines), in ISO format (e.g., 2024-03-06).
+    '''
+    return f"{(things_date & 134152192) >> 16}-{(things_date & 61440) >> 12:02d}-{(things_date & 3968) >> 7:02d}"
+
+def get_area_title(task):
+    '''
+    Returns the title of the area the given task is in, directly or through its project (or its heading's project).
+    '''
+    if 'area_title' in task:
+        return filter_area_title(task['area_title'])
+    return projects.get(task.get('project') or task.get('heading_project'), {}).get('area_title', "")
+
+def get_archive_filepath(database_file_path):
+    '''
+    Returns the path of the given Things database's archive (see update_archive).
+    '''
+    database_name = hashlib.sha256(database_file_path.encode()).hexdigest()[:16]
+    return os.path.join(os.path.dirname(__file__), THINGS2MD_ARCHIVE_FILE.format(database_name))
+
+def get_archived_until(archive_file_path):
+    '''
+    Returns the end (exclusive) of the period covered by the given archive, as a timestamp: tasks completed
+    before then are all in the archive. Returns None if there's no archive.
+    '''
+    if not os.path.exists(archive_file_path):
+        return None
+    try:
+        archive = sqlite3.connect(f"file:{urllib.parse.quote(archive_file_path)}?mode=ro", uri=True)
+        try:
+            row = archive.execute("SELECT value FROM things2md_archive WHERE key = 'archived_until'").fetchone()
+        finally:
+            archive.close()
+    except sqlite3.Error:
+        return None
+    return row[0] if row else None
+
+def get_completion_script(shell):
+    '''
+    Returns the --completion script for the given shell: it adds a things2md command (running this script
+    with this Python), and completes its options, and the names of projects, areas, tags, and templates.
+    '''
+    command = f"{shlex.quote(sys.executable)} {shlex.quote(os.path.abspath(__file__))}"
+    # names are completed by importing the script rather than running it, so that its compiled bytecode
+    # is cached (in __pycache__), rather than compiled on every press of tab
+    script_dir, script_name = os.path.split(os.path.abspath(__file__))
+    import_code = f"import sys; sys.path[0] = {script_dir!r}; import {os.path.splitext(script_name)[0]}"
+    complete_command = f"{shlex.quote(sys.executable)} -c {shlex.quote(import_code)}"
+    options = [option for action in parser._actions if action.help != argparse.SUPPRESS for option in action.option_strings]
+    script = COMPLETION_SCRIPTS[shell]
+    for name, value in dict(command=command, complete_command=complete_command, options=" ".join(options),
+                            name_options="--area|--project|--tag|--template").items():
+        script = script.replace(f"{{{name}}}", value)
+    return script.strip()
+
+def get_cursor_key(cursor, sort_key):
+    '''
+    Returns the values of the given key in TASK_SORT_KEYS for the task with the given uuid (as reported as
+    the cursor for the next page), looked up by primary key in the first database that has it.
+    '''
+    columns, _ = TASK_SORT_KEYS[sort_key]
+    for database_file_path in get_database_filepaths():
+        rows = get_database(database_file_path).execute_query(
+            f"SELECT {', '.join(f'{column} AS key{i}' for i, column in enumerate(columns))} FROM TMTask AS TASK WHERE TASK.uuid = ?",
+            (cursor,))
+        if rows:
+            return [rows[0].get(f"key{i}") for i in range(len(columns))]
+    sys.stderr.write(f"things2md: Invalid cursor: {cursor}\n")
+    exit(errno.EINVAL) # Invalid argument error code
+
+def get_database(database_file_path=None):
+    '''
+    Returns this thread's connection to the given Things database (or to its snapshot, if --snapshot is set;
+    see SNAPSHOTS), opening it on first use. Defaults to the database this thread is querying.
+    '''
+    database_file_path = database_file_path or get_database_filepath()
+    connections = DATABASES.__dict__.setdefault('connections', {})
+    if database_file_path not in connections:
+        # queries wait on Things' locks (e.g., while it syncs) for up to the configured busy timeout, and run
+        # until the --deadline
+        busy_timeout = CONFIG.busy_timeout
+        if DEADLINE is not None:
+            remaining = max(DEADLINE - time.monotonic(), 0)
+            busy_timeout = remaining if busy_timeout is None else min(busy_timeout, remaining)
+        snapshot_file_path = SNAPSHOTS.get(database_file_path)
+        try:
+            if snapshot_file_path is None:
+                if busy_timeout is not None:
+                    # things.py queries the database as it opens it, waiting on locks for SQLite's default timeout;
+                    # so wait for them here first, for no longer than the busy timeout
+                    probe = sqlite3.connect(f"file:{urllib.parse.quote(database_file_path)}?mode=ro", uri=True, timeout=busy_timeout)
+                    try:
+                        probe.execute("SELECT 1 FROM sqlite_master LIMIT 1")
+                    finally:
+                        probe.close()
+                database = Database(filepath=database_file_path, print_sql=DEBUG)
+            else:
+                database = Database(filepath=snapshot_file_path, print_sql=DEBUG)
+                # snapshots never change once written, so SQLite can skip locking them altogether
+                database.connection.close()
+                database.connection = sqlite3.connect(f"file:{urllib.parse.quote(snapshot_file_path)}?mode=ro&immutable=1", uri=True)
+        except (sqlite3.Error, AssertionError, OSError) as e:
+            if is_timeout_error(e):
+                raise
+            sys.stderr.write(f"things2md: Unable to open Things database: {database_file_path}: {e}\n")
+            exit(1)
+        database.connection.create_function("things2md_match_text", 3, match_text, deterministic=True)
+        if busy_timeout is not None:
+            database.connection.execute(f"PRAGMA busy_timeout = {int(busy_timeout * 1000)}")
+        if DEADLINE is not None:
+            database.connection.set_progress_handler(check_deadline, DEADLINE_CHECK_INTERVAL)
+        connections[database_file_path] = database
+    return connections[database_file_path]
+
+def get_database_filepath():
+    '''
+    Returns the path of the Things database this thread is querying: the first of get_database_filepaths(),
+    unless set by query_databases().
+    '''
+    return getattr(DATABASES, 'filepath', None) or get_database_filepaths()[0]
+
+def get_database_filepaths():
+    '''
+    Returns the paths of the Things databases to query: the one things.py resolves, followed by any
+    additional databases in the configuration; or their archives, if those cover the dates requested.
+    '''
+    default_file_path = os.getenv(things.database.ENVIRONMENT_VARIABLE_WITH_FILEPATH) or things.database.DEFAULT_FILEPATH
+    return [ARCHIVES.get(database_file_path, database_file_path) for database_file_path in dict.fromkeys([default_file_path, *CONFIG.databases])]
+
 def get_datetime_range(date_range):
     '''
     Returns dates for the given date range expressed in English, relative to today.
@@ -186,28 +1116,308 @@ def get_datetime_range(date_range):
         return None, None
 
     start_date = start_date.replace(hour=0, minute=0, second=0, microsecond=0)
-    # set the end date to 11:59:59pm, to ensure we get all tasks
-    if end_date:
-        end_date = end_date.replace(hour=23, minute=59, second=59)
-    else:
-        end_date = TODAY.replace(hour=23, minute=59, second=59, microsecond=999999)
+    # set the end date to midnight after the last day (exclusive), to ensure we get all tasks
+    if not end_date:
+        end_date = TODAY
+    end_date = end_date.replace(hour=0, minute=0, second=0, microsecond=0) + relativedelta(days=1)
 
     return start_date, end_date
 
+def get_datetime_period(period):
+    '''
+    Returns the start and (exclusive) end of the given period, in local time. Supported:
+      ISO dates (e.g., 2026-03-14), ISO weeks (e.g., 2026-W11), months (e.g., 2026-03), years (e.g., 2026),
+      and the days expressed in English supported by get_datetime_range (e.g., yesterday, 3 days ago, this week)
+    Returns None, None if the period isn't supported.
+    '''
+    try:
+        if match := re.fullmatch(r'(\d{4})-W(\d{1,2})', period):
+            start_date = datetime.fromisocalendar(int(match[1]), int(match[2]), 1)
+            end_date = start_date + relativedelta(weeks=1)
+        elif re.fullmatch(r'\d{4}-\d{2}-\d{2}', period):
+            start_date = datetime.fromisoformat(period)
+            end_date = start_date + relativedelta(days=1)
+        elif match := re.fullmatch(r'(\d{4})-(\d{2})', period):
+            start_date = datetime(int(match[1]), int(match[2]), 1)
+            end_date = start_date + relativedelta(months=1)
+        elif re.fullmatch(r'\d{4}', period):
+            start_date = datetime(int(period), 1, 1)
+            end_date = start_date + relativedelta(years=1)
+        else:
+            start_date, end_date = get_datetime_range(period)
+            if start_date is None:
+                return None, None
+            # other than weeks, English periods are of a single day
+            if period != "this week":
+                end_date = start_date + relativedelta(days=1)
+            return start_date, end_date
+    except (IndexError, ValueError):
+        return None, None
+
+    return start_date.astimezone(), end_date.astimezone()
+
+def get_invocation_key():
+    '''
+    Returns a key identifying this run's output, for coalesce_invocation: a hash of its arguments (as parsed, so
+    their order doesn't matter), the configuration, the databases queried, and today's date.
+    '''
+    try:
+        with open(os.path.join(os.path.dirname(__file__), THINGS2MD_CONFIG_FILE), "rb") as config_file:
+            config_hash = hashlib.sha256(config_file.read()).hexdigest()
+    except OSError:
+        config_hash = None
+    # not --deadline, which only bounds how long the output takes
+    invocation = dict(args=sorted((arg, value) for arg, value in vars(args).items() if arg != 'deadline'),
+                      config=config_hash, databases=get_database_filepaths(), today=TODAY_DATE.isoformat())
+    return hashlib.sha256(json.dumps(invocation, default=str).encode()).hexdigest()[:16]
+
+def get_note_filename(title, uuid):
+    '''
+    Returns a file name for the note of the given task: its title, without characters that aren't
+    allowed in file names, or its uuid if nothing's left.
+    '''
+    name = FILENAME_PATTERN.sub(" ", title)
+    name = re.sub(r'\s+', ' ', name).strip().lstrip(".")[:120].strip()
+    return f"{name or uuid}.md"
+
+def get_render_fingerprint(task):
+    '''
+    Returns a hash of what the given task's output depends on: each field its template variables are made from
+    (see the render loop in MAIN), including those of its project, heading, and area, and its tags and checklist
+    items, which can change without the task's modification date changing; but not its notes, which can be long,
+    so its modification date (which they change) is hashed instead.
+    '''
+    # fields are read as attributes, rather than through Task's dict interface, as this is called for every task output
+    project = projects.get(task.project or task.heading_project)
+    fields = (task.database, task.modified, task.type, task.title, task.status, task.stop_date, task.deadline,
+              task.project, task.project_title, task.area_title, task.heading, task.heading_title,
+              task.heading_project, task.heading_project_title, task.tags, task.checklist,
+              project and (project.title, project.area_title))
+    return hashlib.blake2b(repr(fields).encode(), digest_size=16).digest()
+
+def get_render_scope():
+    '''
+    Returns a hash of what all tasks' output depends on: the template, filters and formatting, the local time
+    zone (dates are output as local dates), and, if used, the GCal event dates (today's). Output is cached before
+    its wikilinks are resolved, so it doesn't depend on the vault (see resolve_output_wikilinks).
+    '''
+    scope = [RENDER_CACHE_VERSION, sorted(CFG_TEMPLATE.items()), time.timezone, time.tzname,
+             CONFIG.remove_area_emojis, CONFIG.remove_heading_emojis, CONFIG.remove_project_emojis,
+             CONFIG.remove_task_emojis, CONFIG.remove_empty_checklist_items, CONFIG.area_sep, CONFIG.date_sep,
+             CONFIG.deadline_sep, CONFIG.heading_sep, CONFIG.project_sep, sorted(CONFIG.status_symbols.items())]
+    if any("gcal_url" in str(value) for value in CFG_TEMPLATE.values()):
+        scope.append(GCAL_EVENT_DATES)
+    return hashlib.blake2b(repr(scope).encode(), digest_size=16).digest()
+
+def get_skip_tags():
+    '''
+    Returns the skip_tags filter's tags, and all of their descendant tags if skip_subtags is set.
+    '''
+    global SKIP_TAGS
+    if SKIP_TAGS is None:
+        SKIP_TAGS = get_tags_with_descendants(CONFIG.skip_tags) if CONFIG.skip_subtags else CONFIG.skip_tags
+    return SKIP_TAGS
+
+def get_snapshot(database_file_path, max_age):
+    '''
+    Returns the path of a consistent, point-in-time copy of the given database, made with SQLite's
+    backup API. An existing snapshot is reused if it's under max_age seconds old, or if the database
+    hasn't been modified since it was taken. Snapshots are given the database's modification time from
+    before they were taken, as writes made while copying may not be in them; so their age is by their ctime.
+    '''
+    snapshot_name = hashlib.sha256(database_file_path.encode()).hexdigest()[:16]
+    snapshot_file_path = os.path.join(os.path.dirname(__file__), THINGS2MD_CACHE_DIR, f"snapshot-{snapshot_name}.sqlite")
+
+    def get_database_mtime():
+        # changes may only be in the write-ahead log, so check that too
+        wal_file_path = f"{database_file_path}-wal"
+        return max(os.stat(database_file_path).st_mtime_ns, os.stat(wal_file_path).st_mtime_ns if os.path.exists(wal_file_path) else 0)
+
+    try:
+        snapshot_stat = os.stat(snapshot_file_path)
+        if time.time() - snapshot_stat.st_ctime < max_age or get_database_mtime() <= snapshot_stat.st_mtime_ns:
+            if DEBUG: print(f"\nSNAPSHOT: reusing {snapshot_file_path}")
+            return snapshot_file_path
+    except OSError:
+        pass
+
+    if DEBUG: print(f"\nSNAPSHOT: copying {database_file_path} to {snapshot_file_path}")
+    os.makedirs(os.path.dirname(snapshot_file_path), exist_ok=True)
+    # named uniquely, as concurrent runs may each be copying the database
+    temp_fd, temp_file_path = tempfile.mkstemp(dir=os.path.dirname(snapshot_file_path), suffix=".tmp")
+    os.close(temp_fd)
+    try:
+        database_mtime = get_database_mtime()
+        source = sqlite3.connect(f"file:{urllib.parse.quote(database_file_path)}?mode=ro", uri=True)
+        target = sqlite3.connect(temp_file_path)
+        try:
+            # copy all pages in one step, so the copy is of a single point in time
+            source.backup(target)
+        finally:
+            target.close()
+            source.close()
+        os.utime(temp_file_path, ns=(time.time_ns(), database_mtime))
+        # replace atomically, so that concurrent runs reading the previous snapshot are unaffected
+        os.replace(temp_file_path, snapshot_file_path)
+    except (sqlite3.Error, OSError):
+        os.remove(temp_file_path)
+        raise
+
+    return snapshot_file_path
+
+def get_tag_children():
+    '''
+    Returns the tag tree of all databases, as a dict of each tag's title to the titles of its child tags,
+    built on first use with one query per database.
+    '''
+    global TAG_CHILDREN
+    if TAG_CHILDREN is None:
+        results = query_databases(lambda: get_database().execute_query('''
+            SELECT TAG.title, PARENT_TAG.title AS parent
+            FROM TMTag AS TAG
+            LEFT OUTER JOIN TMTag AS PARENT_TAG ON PARENT_TAG.uuid = TAG.parent
+            '''))
+        TAG_CHILDREN = {}
+        for rows in results:
+            for row in rows:
+                TAG_CHILDREN.setdefault(row['title'], set())
+                if row['parent'] is not None:
+                    TAG_CHILDREN.setdefault(row['parent'], set()).add(row['title'])
+    return TAG_CHILDREN
+
+def get_tags_with_descendants(tags):
+    '''
+    Returns the given tag titles, and the titles of all of their descendant tags.
+    '''
+    tag_children = get_tag_children()
+    expanded_tags = set()
+    pending_tags = list(tags)
+    while pending_tags:
+        tag = pending_tags.pop()
+        if tag not in expanded_tags:
+            expanded_tags.add(tag)
+            pending_tags += tag_children.get(tag, ())
+    return frozenset(expanded_tags)
+
+def get_where_date(value):
+    '''
+    Returns the date for the given --where date value: an ISO date (e.g., 2026-03-14); today, yesterday, or
+    tomorrow; or a number of days, weeks, months, or years from today (e.g., 7d, 2w, -1m).
+    '''
+    relative_match = re.fullmatch(r'([+-]?\d+)([dwmy])', value.lower())
+    if relative_match:
+        unit = dict(d='days', w='weeks', m='months', y='years')[relative_match.group(2)]
+        return TODAY_DATE + relativedelta(**{unit: int(relative_match.group(1))})
+    relative_days = dict(yesterday=-1, today=0, tomorrow=1)
+    if value.lower() in relative_days:
+        return TODAY_DATE + relativedelta(days=relative_days[value.lower()])
+    try:
+        return datetime.fromisoformat(value).date()
+    except ValueError:
+        raise ValueError(f"invalid date: {value}")
+
+def group_rows(rows, levels):
+    '''
+    Buckets the given (template variables, markdown) rows into groups, nested by the given levels
+    (e.g., ['area', 'project']), in a single pass. Groups keep the order in which they were first seen.
+    Returns a dict of group key -> (template variables of the group's first row, subgroups), where the
+    subgroups of the last level are lists of rows.
+    '''
+    if not levels:
+        return rows
+    groups = {}
+    for row in rows:
+        row_vars = row[0]
+        subgroups = groups
+        for i, level in enumerate(levels):
+            key = row_vars.get(level, "")
+            if key not in subgroups:
+                subgroups[key] = (row_vars, {} if i < len(levels) - 1 else [])
+            subgroups = subgroups[key][1]
+        subgroups.append(row)
+    return groups
+
 def has_skip_tags(task):
     '''
-    Returns True if any of the tags in the given task/project/area is in ENV_SKIP_TAGS.
+    Returns True if any of the tags in the given task/project/area is in the skip_tags filter.
     '''
     skip = False
-    if CFG_SKIP_TAGS:
-        if ('area' in task) and any(item in areas[task['area']].get('tags', []) for item in CFG_SKIP_TAGS):
+    skip_tags = get_skip_tags()
+    if skip_tags:
+        if ('area' in task) and not skip_tags.isdisjoint(areas[task['area']].get('tags', [])):
             skip = True
-        elif ('project' in task) and any(item in projects[task['project']].get('tags', []) for item in CFG_SKIP_TAGS):
+        elif ('project' in task) and not skip_tags.isdisjoint(projects.get(task['project'], {}).get('tags', [])):
             skip = True
-        elif ('tags' in task) and any(item in task['tags'] for item in CFG_SKIP_TAGS):
+        elif ('tags' in task) and not skip_tags.isdisjoint(task['tags']):
             skip = True
     return skip
 
+def include_task_items(tasks):
+    '''
+    Replaces the tags and checklist flags on the given tasks with their tag titles and checklist
+    items, and sets the project of tasks under a heading, using one query per batch of tasks rather
+    than one per task.
+    '''
+    database = get_database()
+
+    # tasks under a heading are only in a project through the heading
+    heading_tasks = {}
+    for task in tasks:
+        if 'heading' in task and 'project' not in task:
+            heading_tasks.setdefault(task['heading'], []).append(task)
+    uuids = list(heading_tasks)
+    for i in range(0, len(uuids), SQL_IN_CHUNK_SIZE):
+        chunk = uuids[i:i + SQL_IN_CHUNK_SIZE]
+        rows = database.execute_query(f'''
+            SELECT HEADING.uuid AS heading, PROJECT.uuid AS project, PROJECT.title AS project_title
+            FROM TMTask AS HEADING
+            JOIN TMTask AS PROJECT ON PROJECT.uuid = HEADING.project
+            WHERE HEADING.uuid IN ({", ".join("?" * len(chunk))})
+            ''', chunk)
+        for row in rows:
+            for task in heading_tasks[row['heading']]:
+                task['heading_project'] = sys.intern(row['project'])
+                task['heading_project_title'] = sys.intern(row['project_title'])
+
+    tagged_tasks = {task['uuid']: task for task in tasks if task.get('tags')}
+    for task in tagged_tasks.values():
+        task['tags'] = []
+    uuids = list(tagged_tasks)
+    for i in range(0, len(uuids), SQL_IN_CHUNK_SIZE):
+        chunk = uuids[i:i + SQL_IN_CHUNK_SIZE]
+        rows = database.execute_query(f'''
+            SELECT TASK_TAG.tasks AS task, TAG.title
+            FROM TMTaskTag AS TASK_TAG
+            JOIN TMTag AS TAG ON TAG.uuid = TASK_TAG.tags
+            WHERE TASK_TAG.tasks IN ({", ".join("?" * len(chunk))})
+            ORDER BY TAG."index"
+            ''', chunk)
+        for row in rows:
+            tagged_tasks[row['task']]['tags'].append(row['title'])
+
+    checklist_tasks = {task['uuid']: task for task in tasks if task.get('checklist')}
+    for task in checklist_tasks.values():
+        task['checklist'] = []
+    uuids = list(checklist_tasks)
+    for i in range(0, len(uuids), SQL_IN_CHUNK_SIZE):
+        chunk = uuids[i:i + SQL_IN_CHUNK_SIZE]
+        rows = database.execute_query(f'''
+            SELECT
+                CHECKLIST_ITEM.task,
+                CHECKLIST_ITEM.uuid,
+                CHECKLIST_ITEM.title,
+                CASE
+                    WHEN CHECKLIST_ITEM.status = 0 THEN 'incomplete'
+                    WHEN CHECKLIST_ITEM.status = 2 THEN 'canceled'
+                    WHEN CHECKLIST_ITEM.status = 3 THEN 'completed'
+                END AS status
+            FROM TMChecklistItem AS CHECKLIST_ITEM
+            WHERE CHECKLIST_ITEM.task IN ({", ".join("?" * len(chunk))})
+            ORDER BY CHECKLIST_ITEM."index"
+            ''', chunk)
+        for row in rows:
+            checklist_tasks[row.pop('task')]['checklist'].append(row)
+
 def indent_string(string_to_indent):
     '''
     Indents a multi-line string with tabs.
@@ -217,41 +1427,363 @@ def indent_string(string_to_indent):
     indented_string = "\n".join(indented_lines)
     return indented_string
 
+def is_timeout_error(error):
+    '''
+    Returns True if the given SQLite error is from a query interrupted by the --deadline, or that gave up waiting
+    on Things' locks (e.g., while it syncs), so that the last complete output can be output instead.
+    '''
+    return (DEADLINE is not None and isinstance(error, sqlite3.OperationalError)
+            and error.sqlite_errorcode & 0xff in (sqlite3.SQLITE_INTERRUPT, sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED))
+
+def load_vault_links(vault_path):
+    '''
+    Returns the link targets in the given Obsidian vault, by lower-cased name: notes by their names and
+    aliases, and other files (e.g., attachments) by their file names. The vault's index is cached, and
+    only the folders modified since it was last refreshed are re-read (see refresh_vault_index), unless
+    --reindex-vault is set.
+    '''
+    vault_name = hashlib.sha256(vault_path.encode()).hexdigest()[:16]
+    index_file_path = os.path.join(os.path.dirname(__file__), THINGS2MD_VAULT_INDEX_FILE.format(vault_name))
+
+    index = None
+    try:
+        with open(index_file_path, "rb") as index_file:
+            index = pickle.load(index_file)
+        if index.get('version') != VAULT_INDEX_VERSION or ARG_REINDEX_VAULT:
+            index = None
+    except Exception:
+        index = None
+
+    folders = refresh_vault_index(vault_path, index['folders'] if index else {})
+    if index and folders == index['folders']:
+        return index['links']
+
+    # notes' own names take precedence over other notes' aliases
+    links = {}
+    for _, _, files in folders.values():
+        for file_name, aliases in files.items():
+            for alias in aliases:
+                links.setdefault(alias.lower(), file_name[:-3])
+    for _, _, files in folders.values():
+        for file_name in files:
+            name = file_name[:-3] if file_name.endswith(".md") else file_name
+            links[name.lower()] = name
+    if DEBUG: print(f"\nVAULT: {len(links)} link targets in {len(folders)} folders")
+
+    write_cache_file(index_file_path, dict(version=VAULT_INDEX_VERSION, folders=folders, links=links))
+    return links
+
+def make_task_predicates(first_datetime, last_datetime=None, status=None):
+    '''
+    Returns SQL WHERE predicates (and their parameters) for the tasks requested by the arguments,
+    and the key in TASK_SORT_KEYS the tasks are ordered by.
+    By default, tasks are matched by status as the arguments imply; set status to 'stopped' to only match
+    completed or canceled tasks, or to 'any' to not filter by status otherwise.
+    A --where expression with status or date terms matches tasks of any status, unless a date argument is provided.
+    '''
+    if status is None and ARG_WHERE_ANY_STATUS:
+        status = 'any'
+    # filters mirror those of things.tasks(), see:
+    # https://thingsapi.github.io/things.py/things/api.html#tasks
+    where_predicates = [
+        "TASK.rt1_recurrenceRule IS NULL",
+        "AND TASK.trashed = 0",
+        "AND NOT IFNULL(PROJECT.trashed, 0)",
+        "AND NOT IFNULL(PROJECT_OF_HEADING.trashed, 0)",
+    ]
+    parameters = []
+
+    if ARG_PROJECT:
+        where_predicates.append("AND (TASK.project = ? OR PROJECT_OF_HEADING.uuid = ?)")
+        parameters += [ARG_PROJECT_UUID, ARG_PROJECT_UUID]
+
+    if ARG_AREA:
+        # tasks in the area directly, or in one of its projects (or under a heading of one)
+        where_predicates.append("AND COALESCE(TASK.area, PROJECT.area, PROJECT_OF_HEADING.area) = ?")
+        parameters.append(ARG_AREA_UUID)
+
+    if ARG_TAG:
+        if ARG_TAG not in get_tag_children():
+            sys.stderr.write(f"things2md: Tag not found: {ARG_TAG}\n")
+            exit(errno.EINVAL) # Invalid argument error code
+        tags = sorted(get_tags_with_descendants([ARG_TAG])) if ARG_SUBTAGS else [ARG_TAG]
+        # tasks with more than one of the tags are only matched once
+        where_predicates.append(f"""AND TASK.uuid IN (
+            SELECT TASK_TAG.tasks FROM TMTaskTag AS TASK_TAG JOIN TMTag AS TAG ON TAG.uuid = TASK_TAG.tags
+            WHERE TAG.title IN ({", ".join("?" * len(tags))}))""")
+        parameters += tags
+
+    if ARG_WHERE_PREDICATE:
+        where_sql, where_parameters = ARG_WHERE_PREDICATE
+        where_predicates.append(f"AND {where_sql}")
+        parameters += where_parameters
+
+    # skipped by the query, so that pages (see --limit) hold as many tasks as are output
+    skip_predicates, skip_parameters = make_skip_tags_predicates()
+    where_predicates += skip_predicates
+    parameters += skip_parameters
+
+    sort_key = 'index'
+    if status == 'stopped':
+        where_predicates.append("AND TASK.status IN (2, 3)")
+    if first_datetime is not None or last_datetime is not None:
+        # Things stores stop dates as UTC timestamps, so compare with the timestamps of the (local) bounds
+        if first_datetime is not None:
+            where_predicates.append("AND TASK.stopDate >= ?")
+            parameters.append(first_datetime.timestamp())
+        if last_datetime is not None:
+            where_predicates.append("AND TASK.stopDate < ?")
+            parameters.append(last_datetime.timestamp())
+        sort_key = 'date'
+    elif status == 'stopped':
+        sort_key = 'date'
+    elif ARG_DUE:
+        where_predicates.append("AND TASK.deadline IS NOT NULL AND TASK.startDate IS NOT NULL AND TASK.status = 0")
+        sort_key = 'deadline'
+    elif ARG_TODAY:
+        where_predicates.append("AND TASK.startDate IS NOT NULL AND TASK.start = 1 AND TASK.status = 0")
+        sort_key = 'todayIndex'
+    elif status != 'any':
+        where_predicates.append("AND TASK.status = 0")
+
+    if ARG_ORDERBY == "index":
+        sort_key = 'todayIndex'
+
+    return where_predicates, parameters, sort_key
+
+def make_skip_tags_predicates():
+    '''
+    Returns SQL WHERE predicates (and their parameters) that exclude tasks with any of the skip_tags
+    filter's tags on themselves, their project, or their area (or their project's area).
+    '''
+    if not get_skip_tags():
+        return [], []
+    skip_tags = sorted(get_skip_tags())
+    skip_tags_sql = ", ".join("?" * len(skip_tags))
+    # uncorrelated subqueries, so that each is only evaluated once
+    skipped_tasks_sql = f"""SELECT SKIP_TASK_TAG.tasks FROM TMTaskTag AS SKIP_TASK_TAG
+        JOIN TMTag AS SKIP_TAG ON SKIP_TAG.uuid = SKIP_TASK_TAG.tags WHERE SKIP_TAG.title IN ({skip_tags_sql})"""
+    skipped_areas_sql = f"""SELECT SKIP_AREA_TAG.areas FROM TMAreaTag AS SKIP_AREA_TAG
+        JOIN TMTag AS SKIP_TAG ON SKIP_TAG.uuid = SKIP_AREA_TAG.tags WHERE SKIP_TAG.title IN ({skip_tags_sql})"""
+    where_predicates = [
+        f"AND TASK.uuid NOT IN ({skipped_tasks_sql})",
+        f"AND COALESCE(TASK.project, PROJECT_OF_HEADING.uuid, '') NOT IN ({skipped_tasks_sql})",
+        f"AND COALESCE(TASK.area, PROJECT.area, PROJECT_OF_HEADING.area, '') NOT IN ({skipped_areas_sql})",
+    ]
+    return where_predicates, skip_tags * 3
+
+def match_text(text, operator, value):
+    '''
+    SQL function for --where terms with non-ASCII text (see compile_where_term). Returns whether the given text,
+    ignoring case, is the given casefolded value (or contains it, for the `~` operator).
+    '''
+    text = text.casefold()
+    return (value in text) if operator == "~" else (text == value)
+
+def merge_tasks(results, sort_key, limit=None):
+    '''
+    Merges the (tasks, next cursor) results of fetch_tasks from each database, each already ordered by the
+    given key in TASK_SORT_KEYS, into one ordered page without sorting them again. Tasks found in more than
+    one database are only kept once, from the first database they're in.
+    Returns the tasks, and the cursor for the next page (or None if this is the last page).
+    '''
+    if len(results) == 1:
+        return results[0]
+    key = TASK_MERGE_KEYS[sort_key]
+    reverse = TASK_SORT_KEYS[sort_key][1] == 'DESC'
+
+    # a database with another page could have more tasks after its last one, so the merged
+    # page can only go as far as the earliest of those last tasks
+    cutoff = None
+    for tasks, next_cursor in results:
+        if next_cursor:
+            last_key = key(tasks[-1])
+            if cutoff is None or (last_key > cutoff if reverse else last_key < cutoff):
+                cutoff = last_key
+
+    merged_tasks = []
+    uuids = set()
+    truncated = cutoff is not None
+    # ties (i.e., the same task) are taken from the databases in order
+    for task in heapq.merge(*(tasks for tasks, _ in results), key=key, reverse=reverse):
+        if cutoff is not None and (key(task) < cutoff if reverse else key(task) > cutoff):
+            break
+        if task['uuid'] in uuids:
+            continue
+        if limit and len(merged_tasks) == limit:
+            truncated = True
+            break
+        uuids.add(task['uuid'])
+        merged_tasks.append(task)
+
+    next_cursor = merged_tasks[-1]['uuid'] if truncated and merged_tasks else None
+    return merged_tasks, next_cursor
+
+def open_render_cache():
+    '''
+    Returns a connection to the render cache, of each task's output (template variables, and markdown) as last
+    rendered in each scope (see get_render_scope), along with the task's fingerprint (see get_render_fingerprint).
+    '''
+    cache_file_path = os.path.join(os.path.dirname(__file__), THINGS2MD_RENDER_CACHE_FILE)
+    os.makedirs(os.path.dirname(cache_file_path), exist_ok=True)
+    cache = sqlite3.connect(cache_file_path)
+    cache.executescript('''
+        CREATE TABLE IF NOT EXISTS fragment (scope BLOB NOT NULL, uuid TEXT NOT NULL, fingerprint BLOB NOT NULL,
+                                             vars BLOB NOT NULL, markdown TEXT NOT NULL, used_at REAL NOT NULL,
+                                             PRIMARY KEY (scope, uuid));
+        CREATE INDEX IF NOT EXISTS fragment_used_at ON fragment (used_at);
+        ''')
+    return cache
+
+def order_rows(rows, key, limit=None, after=None):
+    '''
+    Orders rows by the given composite key function, which is computed once per row.
+    If a limit is given, only that many rows are selected, using a heap in O(n log limit) rather than
+    sorting all rows. If `after` is given, only rows ordered after the row with that uuid are selected.
+    Returns the ordered rows, and the cursor for the next page (or None if this is the last page).
+    '''
+    keyed_rows = [(key(row), row) for row in rows]
+    if after:
+        after_key = next((row_key for row_key, row in keyed_rows if row['uuid'] == after), None)
+        if after_key is None:
+            sys.stderr.write(f"things2md: Invalid cursor: {after}\n")
+            exit(errno.EINVAL) # Invalid argument error code
+        keyed_rows = [keyed_row for keyed_row in keyed_rows if keyed_row[0] > after_key]
+
+    # keys are unique, so rows themselves are never compared
+    if limit and len(keyed_rows) > limit:
+        keyed_rows = heapq.nsmallest(limit, keyed_rows)
+        return [row for row_key, row in keyed_rows], keyed_rows[-1][1]['uuid']
+    keyed_rows.sort()
+    return [row for row_key, row in keyed_rows], None
+
+def print_groups(groups, levels):
+    '''
+    Prints grouped rows (see group_rows), preceded by the groupby_* template header for each group.
+    Rows without a value for a level are printed first, without a header.
+    '''
+    if not levels:
+        for row_vars, row_md in groups:
+            print(row_md)
+        return
+    header_template = CFG_TEMPLATE.get(f"groupby_{levels[0]}")
+    for key, (header_vars, subgroups) in sorted(groups.items(), key=lambda group: group[0] != ""):
+        if key and header_template:
+            try:
+                print(header_template.format(**header_vars))
+            except KeyError as e:
+                sys.stderr.write(f"things2md: Invalid groupby_{levels[0]} template variable: '{e.args[0]}'.")
+                exit(1)
+        print_groups(subgroups, levels[1:])
+
+def print_tree(tree):
+    '''
+    Prints the outline of a project (see build_tree): the rows not under a heading, then each heading
+    per the `heading` template, followed by its rows indented beneath it.
+    '''
+    root_rows, headings = tree
+    for row_vars, row_md in root_rows:
+        print(row_md)
+    for heading, rows in headings:
+        heading_vars = dict(heading=heading['title'], title=heading['title'], project=ARG_PROJECT,
+                            url=things.link(heading['uuid']), uuid=heading['uuid'])
+        try:
+            print(CFG_TEMPLATE.get("heading").format(**heading_vars))
+        except KeyError as e:
+            sys.stderr.write(f"things2md: Invalid heading template variable: '{e.args[0]}'.")
+            exit(1)
+        for row_vars, row_md in rows:
+            print(indent_string(row_md))
+
 def query_areas():
     '''
-    Fetches areas.
+    Fetches areas, from all databases.
     '''
-    kwargs = dict()
-    if DEBUG: kwargs['print_sql'] = True; print("\nAREAS QUERY:")
+    if DEBUG: print("\nAREAS QUERY:")
 
     try:
-        areas = things.areas(**kwargs)
+        results = query_databases(lambda: things.areas(database=get_database()))
     except ValueError as ve:
         sys.stderr.write(f"things2md: Things.py Error: {ve.args[0]}\n")
         exit(1)
 
-    return areas
+    # areas found in more than one database are only kept once, from the first database they're in
+    areas = {}
+    for area_results in results:
+        for area in area_results:
+            areas.setdefault(area['uuid'], area)
+    return list(areas.values())
 
-def query_projects(first_datetime):
+def query_concurrently(*queries):
     '''
-    Fetches projects not finished, or finished within the range provided.
+    Runs the given query functions (which take no arguments) concurrently on a thread pool, each with its own
+    connections to the databases, so that independent queries take about as long as the slowest one.
+    Returns their results, in order.
     '''
-    kwargs = dict(status=None)
-    if DEBUG: kwargs['print_sql'] = True; print("\nPROJECT QUERY:")
+    def run_query(query):
+        try:
+            return query()
+        finally:
+            close_databases()
 
     try:
-        projects = things.projects(stop_date=False, **kwargs)
-    except ValueError as ve:
-        sys.stderr.write(f"things2md: Things.py Error: {ve.args[0]}\n")
-        exit(1)
-    
+        with ThreadPoolExecutor(max_workers=len(queries)) as executor:
+            return list(executor.map(run_query, queries))
+    except sqlite3.OperationalError as e:
+        if is_timeout_error(e):
+            exit_with_cached_output(e)
+        raise
+
+def query_databases(query, *args, **kwargs):
+    '''
+    Runs the given query function against each Things database, concurrently on a thread pool (with one
+    connection per thread), so that querying several databases takes about as long as the slowest one.
+    Returns the results, in the order of get_database_filepaths().
+    '''
+    database_file_paths = get_database_filepaths()
+
+    def query_database(database_file_path):
+        DATABASES.filepath = database_file_path
+        try:
+            return query(*args, **kwargs)
+        finally:
+            close_databases()
+            DATABASES.filepath = None
+
+    try:
+        if len(database_file_paths) == 1:
+            return [query(*args, **kwargs)]
+        with ThreadPoolExecutor(max_workers=len(database_file_paths)) as executor:
+            return list(executor.map(query_database, database_file_paths))
+    except sqlite3.OperationalError as e:
+        if is_timeout_error(e):
+            exit_with_cached_output(e)
+        raise
+
+def query_projects(first_datetime):
+    '''
+    Fetches projects not finished, or finished since the start of the range provided. Projects finished after
+    the range are included too, as tasks completed within the range may be in them.
+    '''
+    if DEBUG: print("\nPROJECT QUERY:")
+
+    # filters mirror those of things.projects(), with the stop date bounded by the (UTC) timestamp of the range's start
+    where_predicates = [
+        "TASK.rt1_recurrenceRule IS NULL",
+        "AND TASK.trashed = 0",
+        "AND TASK.type = 1",
+    ]
+    parameters = []
+    if ARG_AREA:
+        where_predicates.append("AND TASK.area = ?")
+        parameters.append(ARG_AREA_UUID)
     if first_datetime is not None:
-        # FIXME: note that this drops the timezone, as Things works off UTC
-        # sounds like this needs to be fixed in Things.py:
-        # https://github.com/chrisgurney/things2md/pull/2#issuecomment-1967535472
-        # ...or not? (similar discussion here:) https://github.com/PyGithub/PyGithub/issues/512
-        stop_date = first_datetime.strftime("%Y-%m-%d")
-        projects += things.projects(stop_date=f'>{stop_date}', **kwargs)
+        where_predicates.append("AND (TASK.stopDate IS NULL OR TASK.stopDate >= ?)")
+        parameters.append(first_datetime.timestamp())
+    else:
+        where_predicates.append("AND TASK.stopDate IS NULL")
+
+    projects, _ = merge_tasks(query_databases(fetch_tasks, where_predicates, parameters, 'index'), 'index')
 
     #
     # filter projects
@@ -259,132 +1791,681 @@ def query_projects(first_datetime):
 
     for project in projects:
         project['notes'] = filter_notes(project['notes'])
-        if CFG_REMOVE_AREA_EMOJIS and 'area_title' in project:
+        if CONFIG.remove_area_emojis and 'area_title' in project:
             project['area_title'] = filter_area_title(project['area_title'])
-        if CFG_REMOVE_PROJECT_EMOJIS:
+        if CONFIG.remove_project_emojis:
             project['title'] = filter_project_title(project['title'])
 
     #
     # order projects based on arguments
     #
 
-    if ARG_ORDERBY == "project":
-        projects.sort(key=lambda x: x.get("title","").casefold())
-    elif ARG_ORDERBY == "area":
-        projects.sort(key=lambda x: x.get("area_title","").casefold())
+    if ARG_ORDERBY in PROJECT_ORDER_KEYS:
+        projects, _ = order_rows(projects, PROJECT_ORDER_KEYS[ARG_ORDERBY])
 
     return projects
 
-def query_tasks(first_datetime, last_datetime = None):
+def query_project_tree(first_datetime, last_datetime):
     '''
-    Fetches tasks completed within the range provided.
+    Fetches all of the --project's tasks requested (with their checklists), and its headings, for --tree.
+    Both are in project order, as the tree is built from them without sorting (see build_tree).
+    Returns the tasks, and the headings.
     '''
-    # things.py parameter documention here:
-    # https://thingsapi.github.io/things.py/things/api.html#tasks
+    where_predicates, parameters, _ = make_task_predicates(first_datetime, last_datetime)
+    tasks, _ = merge_tasks(query_databases(fetch_tasks, where_predicates, parameters, 'index'), 'index')
+    filter_tasks(tasks)
+
+    where_predicates = [
+        "TASK.trashed = 0",
+        "AND TASK.type = 2",
+        "AND TASK.project = ?",
+    ]
+    headings, _ = merge_tasks(query_databases(fetch_tasks, where_predicates, [ARG_PROJECT_UUID], 'index'), 'index')
+    for heading in headings:
+        heading['title'] = filter_heading_title(heading['title'])
+
+    return tasks, headings
+
+def query_search(first_datetime, last_datetime, search_query):
+    '''
+    Fetches the tasks and projects best matching the given words in their titles, notes, or checklist
+    items, from all databases, using their full-text search indexes (see refresh_search_index).
+    Returns the tasks, ranked by relevance.
+    '''
+    # quote each word, so that they're matched as-is rather than as FTS5 query syntax;
+    # a trailing * still matches words starting with the given prefix
+    fts_query = " ".join('"' + word.rstrip("*").replace('"', '""') + '"' + ("*" if word.endswith("*") else "")
+                         for word in search_query.split() if word.rstrip("*"))
+    if not fts_query:
+        return []
+
+    # other arguments (e.g., --tag, --project, --range) narrow the results
+    where_predicates, parameters, sort_key = make_task_predicates(first_datetime, last_datetime, status='any')
+    results = query_databases(search_database, fts_query, where_predicates, parameters, sort_key)
+
+    # each database's matches are already ranked, so merge them by rank
+    tasks = []
+    uuids = set()
+    for rank, task in heapq.merge(*results, key=lambda result: result[0]):
+        if task['uuid'] in uuids:
+            continue
+        uuids.add(task['uuid'])
+        tasks.append(task)
+        if ARG_LIMIT and len(tasks) >= ARG_LIMIT:
+            break
 
-    kwargs = dict(include_items=True)
+    filter_tasks(tasks)
+    return tasks
 
-    if ARG_PROJECT:
-        kwargs['project'] = ARG_PROJECT_UUID
+def query_stats(first_datetime, last_datetime, dimension):
+    '''
+    Counts to-dos completed and canceled within the range provided, grouped by the given dimension
+    (see STATS_DIMENSIONS). Counting is done by the query, so no task rows are loaded; with more than one
+    database, tasks found in several are only counted once, so each task's key is loaded instead.
+    Returns a list of dicts with the group's key, and its completed and canceled counts.
+    '''
+    key_sql, joins_sql = STATS_DIMENSIONS[dimension]
+    where_predicates, parameters, _ = make_task_predicates(first_datetime, last_datetime, status='stopped')
 
-    if ARG_TAG:
-        kwargs['tag'] = ARG_TAG
+    if len(get_database_filepaths()) == 1:
+        select_sql = "SUM(TASK.status = 3) AS completed, SUM(TASK.status = 2) AS canceled"
+        group_sql = "GROUP BY key"
+    else:
+        select_sql = "TASK.uuid, TASK.status = 3 AS completed, TASK.status = 2 AS canceled"
+        group_sql = ""
+
+    sql_query = f"""
+        SELECT
+            {key_sql} AS key,
+            {select_sql}
+        FROM
+            TMTask AS TASK
+        LEFT OUTER JOIN
+            TMTask PROJECT ON TASK.project = PROJECT.uuid
+        LEFT OUTER JOIN
+            TMArea AREA ON TASK.area = AREA.uuid
+        LEFT OUTER JOIN
+            TMTask HEADING ON TASK.heading = HEADING.uuid
+        LEFT OUTER JOIN
+            TMTask PROJECT_OF_HEADING ON HEADING.project = PROJECT_OF_HEADING.uuid
+        {joins_sql}
+        WHERE
+            {chr(10).join(where_predicates)}
+            AND TASK.type = 0
+            AND {key_sql} IS NOT NULL
+        {group_sql}
+        """
+    results = query_databases(lambda: get_database().execute_query(sql_query, parameters))
+
+    # apply title filters; groups may merge if their titles only differ by emojis
+    title_filter = {'area': filter_area_title, 'project': filter_project_title}.get(dimension)
+    stats = {}
+    counted = set()
+    for row in (row for rows in results for row in rows):
+        if 'uuid' in row:
+            if (row['key'], row['uuid']) in counted:
+                continue
+            counted.add((row['key'], row['uuid']))
+        key = title_filter(row['key']) if title_filter else row['key']
+        group = stats.setdefault(key, dict(key=key, completed=0, canceled=0))
+        group['completed'] += row['completed']
+        group['canceled'] += row['canceled']
 
-    if first_datetime is not None:
-        kwargs['status'] = None
-        # FIXME: note that this drops the timezone, as Things works off UTC
-        # sounds like this needs to be fixed in Things.py:
-        # https://github.com/chrisgurney/things2md/pull/2#issuecomment-1967535472
-        # ...or not? (similar discussion here:) https://github.com/PyGithub/PyGithub/issues/512
-        stop_date = first_datetime.strftime("%Y-%m-%d")
-        kwargs['stop_date'] = f'>{stop_date}'
-    elif ARG_DATE:
-        kwargs['status'] = None
-        kwargs['stop_date'] = f'{ARG_DATE.strftime("%Y-%m-%d")}'
-    elif ARG_DUE:
-        kwargs['deadline'] = True
-        kwargs['start_date'] = True
-        kwargs['status'] = 'incomplete' # default, but leaving here for clarity
-    elif ARG_TODAY:
-        kwargs['start_date'] = True
-        kwargs['start'] = 'Anytime'
-        kwargs['index'] = 'todayIndex'
+    if dimension == 'day':
+        return sorted(stats.values(), key=lambda group: group['key'], reverse=True)
+    return sorted(stats.values(), key=lambda group: (-(group['completed'] + group['canceled']), group['key'].casefold()))
+
+def query_task_results(first_datetime, last_datetime):
+    '''
+    Fetches the tasks to output, as requested by the arguments: search results, a --project's tree, or tasks.
+    Returns the tasks, the headings (for --tree), and the cursor for the next page (or None if this is the last page).
+    '''
+    if ARG_SEARCH:
+        return query_search(first_datetime, last_datetime, ARG_SEARCH), [], None
+    if ARG_TREE:
+        tasks, headings = query_project_tree(first_datetime, last_datetime)
+        return tasks, headings, None
+    tasks, next_cursor = query_tasks(first_datetime, last_datetime)
+    return tasks, [], next_cursor
+
+def query_tasks(first_datetime, last_datetime):
+    '''
+    Fetches tasks completed within the range provided.
+    With --since-last, only those completed after the state file's mark are fetched, all at once.
+    Returns the tasks, and the cursor for the next page (or None if this is the last page).
+    '''
+    limit = ARG_LIMIT
+    if ARG_SINCE_LAST:
+        where_predicates, parameters, sort_key = make_task_predicates(first_datetime, last_datetime, status='stopped')
+        if ARG_SINCE_LAST_MARK:
+            # tasks completed at the mark itself may not all have been fetched last time
+            uuids = ARG_SINCE_LAST_MARK['uuids']
+            where_predicates.append(f"AND TASK.stopDate >= ? AND TASK.uuid NOT IN ({', '.join('?' * len(uuids))})")
+            parameters += [ARG_SINCE_LAST_MARK['stop_date'], *uuids]
+        # the mark only advances past tasks that were fetched, so fetch all of them
+        limit = None
     else:
-        kwargs['status'] = 'incomplete' # default, but leaving here for clarity
+        where_predicates, parameters, sort_key = make_task_predicates(first_datetime, last_datetime)
 
-    if ARG_ORDERBY == "index":
-        kwargs['index'] = 'todayIndex'
+    if ARG_ORDERBY in TASK_ORDER_KEYS:
+        # ordered in Python below, so the page can only be selected after fetching all matches
+        tasks, next_cursor = merge_tasks(query_databases(fetch_tasks, where_predicates, parameters, sort_key, partial=True), sort_key)
+    else:
+        after_key = get_cursor_key(ARG_AFTER, sort_key) if ARG_AFTER else None
+        results = query_databases(fetch_tasks, where_predicates, parameters, sort_key, after_key, limit, partial=True)
+        tasks, next_cursor = merge_tasks(results, sort_key, limit=limit)
+
+    filter_tasks(tasks)
+
+    #
+    # sort based on arguments (tasks are already in date, deadline, or index order from the query)
+    #
+
+    if ARG_ORDERBY in TASK_ORDER_KEYS:
+        tasks, next_cursor = order_rows(tasks, TASK_ORDER_KEYS[ARG_ORDERBY], limit=limit, after=ARG_AFTER)
 
-    if DEBUG: kwargs['print_sql'] = True; print("\nTASK QUERY:")
+    return tasks, next_cursor
 
+def read_since_last_mark(state_file_path):
+    '''
+    Returns the mark stored in the given --since-last state file: the latest stop date (as a timestamp) of
+    the tasks fetched so far, and the uuids of the tasks completed at that time. Returns None if there's
+    no state file yet.
+    '''
     try:
-        tasks = things.tasks(**kwargs)
-    except ValueError as ve:
-        sys.stderr.write(f"things2md: Things.py Error: {ve.args[0]}\n")
+        with open(state_file_path, encoding="utf-8") as state_file:
+            mark = json.load(state_file)
+        return dict(stop_date=float(mark['stop_date']), uuids=list(mark['uuids']))
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        sys.stderr.write(f"things2md: Unable to read state file: {state_file_path}: {e}\n")
         exit(1)
-        
-    # FIXME: get tasks for next day if last_datetime is provided as well
-    # get next day's tasks as well, so that we can account for GMT being past midnight local time
-    if ARG_DATE: # or last_datetime
-        # if ARG_DATE:
-        given_date_obj = ARG_DATE
-        # if last_datetime:
-            # given_date_obj = last_datetime
-        next_day_date_obj = given_date_obj + relativedelta(days=1)
-        next_day_date = next_day_date_obj.strftime("%Y-%m-%d")
-
-        kwargs['stop_date'] = f'{next_day_date}'
-        next_day_tasks = things.tasks(**kwargs)
-        tasks = tasks + next_day_tasks
 
-    #
-    # filter tasks
-    #
+def read_note_aliases(note_file_path):
+    '''
+    Returns the aliases listed in the given note's YAML front matter (as `aliases: [a, b]`, or as a list of
+    `- a` lines), or an empty tuple if it has none.
+    '''
+    aliases = []
+    try:
+        with open(note_file_path, encoding="utf-8", errors="replace") as note_file:
+            if note_file.readline().rstrip() != "---":
+                return ()
+            in_aliases = False
+            for line in note_file:
+                line = line.rstrip()
+                if line == "---":
+                    break
+                key, sep, value = line.partition(":")
+                if in_aliases and line.lstrip().startswith("- "):
+                    aliases.append(line.lstrip()[2:])
+                elif sep and not line.startswith((" ", "\t")):
+                    in_aliases = key in ("aliases", "alias")
+                    if in_aliases and value.strip():
+                        aliases.extend(value.strip().strip("[]").split(","))
+    except OSError:
+        return ()
+    return tuple(alias.strip().strip("'\"") for alias in aliases if alias.strip().strip("'\""))
+
+def read_render_cache(scope, uuids):
+    '''
+    Returns the cached output of the given tasks in the given scope (see open_render_cache), as a dict of
+    uuid -> (fingerprint, pickled template variables, markdown, time last used). Caches are optional, so
+    failures are ignored.
+    '''
+    fragments = {}
+    try:
+        cache = open_render_cache()
+        for i in range(0, len(uuids), SQL_IN_CHUNK_SIZE):
+            chunk = uuids[i:i + SQL_IN_CHUNK_SIZE]
+            rows = cache.execute(f'''
+                SELECT uuid, fingerprint, vars, markdown, used_at FROM fragment
+                WHERE scope = ? AND uuid IN ({", ".join("?" * len(chunk))})
+                ''', [scope] + chunk)
+            fragments.update((row[0], row[1:]) for row in rows)
+        cache.close()
+    except (sqlite3.Error, OSError):
+        return {}
+    return fragments
+
+def refresh_search_index(index_file_path):
+    '''
+    Brings the full-text search index of task and project titles, notes, and checklist items up to date,
+    by re-indexing only those modified since the index was last refreshed.
+    Returns a connection to the index.
+    '''
+    database = get_database()
+    os.makedirs(os.path.dirname(index_file_path), exist_ok=True)
+    index = sqlite3.connect(index_file_path)
+    index.executescript('''
+        CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value);
+        CREATE TABLE IF NOT EXISTS document (id INTEGER PRIMARY KEY, uuid TEXT UNIQUE NOT NULL);
+        CREATE VIRTUAL TABLE IF NOT EXISTS task_fts USING fts5(title, notes, checklist, tokenize='unicode61 remove_diacritics 2');
+        ''')
+    state = dict(index.execute("SELECT key, value FROM state"))
+
+    # rebuild the index if it was built from another database
+    modified_since = state.get('modified_since', 0)
+    if state.get('filepath') != get_database_filepath():
+        index.execute("DELETE FROM document")
+        index.execute("DELETE FROM task_fts")
+        modified_since = 0
+
+    changed_tasks = database.execute_query('''
+        SELECT uuid, title, notes, userModificationDate AS modified
+        FROM TMTask WHERE type IN (0, 1) AND userModificationDate > ?
+        ''', (modified_since,))
+    changed_checklists = database.execute_query('''
+        SELECT task, MAX(userModificationDate) AS modified
+        FROM TMChecklistItem WHERE userModificationDate > ? GROUP BY task
+        ''', (modified_since,))
+    if DEBUG: print(f"\nSEARCH INDEX: {len(changed_tasks)} tasks, {len(changed_checklists)} checklists modified since {modified_since}")
+    if not changed_tasks and not changed_checklists:
+        return index
+
+    # tasks whose checklist items changed are re-indexed as a whole
+    changed_task_uuids = {task['uuid'] for task in changed_tasks}
+    checklist_task_uuids = [row['task'] for row in changed_checklists if row['task'] not in changed_task_uuids]
+    for i in range(0, len(checklist_task_uuids), SQL_IN_CHUNK_SIZE):
+        chunk = checklist_task_uuids[i:i + SQL_IN_CHUNK_SIZE]
+        changed_tasks += database.execute_query(f'''
+            SELECT uuid, title, notes, userModificationDate AS modified
+            FROM TMTask WHERE type IN (0, 1) AND uuid IN ({", ".join("?" * len(chunk))})
+            ''', chunk)
+
+    checklists = {}
+    if modified_since == 0:
+        checklist_rows = database.execute_query('''
+            SELECT task, group_concat(title, char(10)) AS titles FROM TMChecklistItem GROUP BY task
+            ''')
+        checklists = {row['task']: row['titles'] for row in checklist_rows}
+    else:
+        uuids = [task['uuid'] for task in changed_tasks]
+        for i in range(0, len(uuids), SQL_IN_CHUNK_SIZE):
+            chunk = uuids[i:i + SQL_IN_CHUNK_SIZE]
+            checklist_rows = database.execute_query(f'''
+                SELECT task, group_concat(title, char(10)) AS titles FROM TMChecklistItem
+                WHERE task IN ({", ".join("?" * len(chunk))}) GROUP BY task
+                ''', chunk)
+            checklists.update({row['task']: row['titles'] for row in checklist_rows})
+
+    with index:
+        for task in changed_tasks:
+            document = index.execute("SELECT id FROM document WHERE uuid = ?", (task['uuid'],)).fetchone()
+            if document:
+                index.execute("DELETE FROM task_fts WHERE rowid = ?", document)
+                document_id = document[0]
+            else:
+                document_id = index.execute("INSERT INTO document (uuid) VALUES (?)", (task['uuid'],)).lastrowid
+            index.execute("INSERT INTO task_fts (rowid, title, notes, checklist) VALUES (?, ?, ?, ?)",
+                          (document_id, task['title'], task['notes'], checklists.get(task['uuid'])))
 
-    for task in tasks:
-        task['notes'] = filter_notes(task['notes'])
-        if CFG_REMOVE_TASK_EMOJIS: task['title'] = filter_task_title(task['title'])
-        if CFG_REMOVE_PROJECT_EMOJIS and 'project_title' in task:
-            task['project_title'] = filter_project_title(task['project_title'])
-        if CFG_REMOVE_HEADING_EMOJIS and 'heading_title' in task:
-            task['heading_title'] = filter_heading_title(task['heading_title'])
+        modified_since = max([modified_since] + [row['modified'] for row in changed_tasks + changed_checklists])
+        index.executemany("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)",
+                          [('filepath', get_database_filepath()), ('modified_since', modified_since)])
 
-    #
-    # order + group based on arguments
-    #
+    return index
 
-    # return tasks based on the provided date
-    if ARG_DATE:
-        given_date_local = given_date_obj.astimezone()
-        given_date_local_eod = given_date_local.replace(hour=23, minute=59, second=59)
-        # FIXME: do when we have an end date set 
-        for item in tasks[:]:
-            # FIXME: should this instead specify that this is UTC?
-            stop_date_local = datetime.strptime(item['stop_date'], "%Y-%m-%d %H:%M:%S").astimezone()
-            if stop_date_local > given_date_local and stop_date_local <= given_date_local_eod:
-                pass
+def refresh_vault_index(vault_path, folders):
+    '''
+    Brings the given index of the vault's folders up to date. A folder's modification time changes whenever
+    files are added to, removed from, or renamed within it, so only those modified since they were last
+    indexed are re-read (including the aliases of their notes); others are only checked for modification.
+    Hidden folders and files (e.g., .obsidian) are skipped, as Obsidian does.
+    Returns the index: (modification time, subfolders, {file name: aliases}), by folder path within the vault.
+    '''
+    refreshed = {}
+    pending = [""]
+    while pending:
+        folder = pending.pop()
+        try:
+            modified = os.stat(os.path.join(vault_path, folder)).st_mtime_ns
+            if folder in folders and folders[folder][0] == modified:
+                refreshed[folder] = folders[folder]
             else:
-                tasks.remove(item)
+                subfolders = []
+                files = {}
+                with os.scandir(os.path.join(vault_path, folder)) as entries:
+                    for entry in entries:
+                        if entry.name.startswith("."):
+                            continue
+                        if entry.is_dir():
+                            subfolders.append(os.path.join(folder, entry.name))
+                        elif entry.name.endswith(".md"):
+                            files[entry.name] = read_note_aliases(entry.path)
+                        else:
+                            files[entry.name] = ()
+                refreshed[folder] = (modified, tuple(subfolders), files)
+                if DEBUG: print(f"VAULT FOLDER REINDEXED: {folder or '/'}")
+        except OSError:
+            if folder == "":
+                sys.stderr.write(f"things2md: Unable to read vault: {vault_path}\n")
+                exit(1)
+            continue
+        pending.extend(refreshed[folder][1])
+    return refreshed
 
-    #
-    # sort based on arguments
-    #
-   
-    if ARG_ORDERBY == "project":
-        tasks.sort(key=lambda x: x['stop_date'] if x['stop_date'] is not None else float('-inf'), reverse=True)
-        tasks.sort(key=lambda x: x.get("project_title","").casefold())
-    elif ARG_ORDERBY == 'index':
-        pass
-    elif ARG_DUE:
-        tasks.sort(key=lambda x: x['deadline'])
-    elif ARG_TODAY:
+def resolve_wikilinks(markdown, vault_links):
+    '''
+    Resolves the wikilinks in the given Markdown against the vault's link targets (see load_vault_links):
+    links to notes (or files) are kept; links to an alias are pointed at its note, keeping the linked text;
+    and links to anything else are replaced by their text, so they don't dangle.
+    '''
+    def resolve_wikilink(match):
+        target, section, text = match.group(1), match.group(2) or "", match.group(3)
+        target_name = target.strip().rsplit("/", 1)[-1].lower() # links may include the note's folder
+        name = vault_links.get(target_name)
+        if name is None:
+            return text if text is not None else target
+        if name.lower() == target_name:
+            return match.group(0)
+        return f"[[{name}{section}|{text if text is not None else target}]]"
+    return WIKILINK_PATTERN.sub(resolve_wikilink, markdown)
+
+def resolve_output_wikilinks(markdown, vault_links):
+    '''
+    Resolves the wikilinks in the given output of a task or project (see resolve_wikilinks): all of a note's,
+    or only those in the first line of others (not in their notes or checklists), which is then tidied up again.
+    '''
+    if CFG_TEMPLATE.get('type') == 'markdown_note':
+        return resolve_wikilinks(markdown, vault_links)
+    line, newline, rest = markdown.partition("\n")
+    line = re.sub(r'\s+', ' ', resolve_wikilinks(line, vault_links).strip())
+    return line + newline + rest
+
+def search_database(fts_query, where_predicates, parameters, sort_key):
+    '''
+    Fetches the tasks in this thread's database best matching the given FTS5 query, and the given SQL predicates.
+    Returns (rank, task) tuples, best matches (lowest ranks) first.
+    '''
+    database_name = hashlib.sha256(get_database_filepath().encode()).hexdigest()[:16]
+    try:
+        index = refresh_search_index(os.path.join(os.path.dirname(__file__), THINGS2MD_SEARCH_INDEX_FILE.format(database_name)))
+        # weigh matches in titles over checklist items, and those over notes
+        rows = index.execute('''
+            SELECT DOCUMENT.uuid, bm25(task_fts, 10.0, 1.0, 2.0) AS rank
+            FROM task_fts JOIN document AS DOCUMENT ON DOCUMENT.id = task_fts.rowid
+            WHERE task_fts MATCH ?
+            ORDER BY rank
+            ''', (fts_query,)).fetchall()
+        index.close()
+    except (sqlite3.Error, OSError) as e:
+        sys.stderr.write(f"things2md: Unable to search: {e}\n")
+        exit(1)
+    ranks = dict(rows)
+    ranked_uuids = list(ranks)
+
+    # fetch the best matches in batches, until there are enough results
+    results = []
+    for i in range(0, len(ranked_uuids), SQL_IN_CHUNK_SIZE):
+        chunk = ranked_uuids[i:i + SQL_IN_CHUNK_SIZE]
+        chunk_tasks, _ = fetch_tasks(where_predicates + [f"AND TASK.uuid IN ({', '.join('?' * len(chunk))})"],
+                                     parameters + chunk, sort_key)
+        results += sorted(((ranks[task['uuid']], task) for task in chunk_tasks), key=lambda result: result[0])
+        if ARG_LIMIT and len(results) >= ARG_LIMIT:
+            results = results[:ARG_LIMIT]
+            break
+
+    return results
+
+def update_archive():
+    '''
+    Brings the archive of this thread's database up to date: a copy of its to-dos completed or canceled before
+    today, along with all of its projects, headings, areas, and tags, with the same schema (so it can be queried
+    in place of the database), but indexed for querying by stop date, project, and tag. Only to-dos completed,
+    modified, or removed since the archive was last updated are copied (or removed) again.
+    Returns the number of to-dos copied, and the end (exclusive) of the period archived, as a timestamp.
+    '''
+    database_file_path = get_database_filepath()
+    archive_file_path = get_archive_filepath(database_file_path)
+    updated_at = time.time()
+    archived_until = TODAY_TIMESTAMP
+    try:
+        os.makedirs(os.path.dirname(archive_file_path), exist_ok=True)
+        archive = sqlite3.connect(f"file:{urllib.parse.quote(archive_file_path)}", uri=True)
+        archive.execute("ATTACH DATABASE ? AS live", (f"file:{urllib.parse.quote(database_file_path)}?mode=ro",))
+        archive.execute("CREATE TABLE IF NOT EXISTS things2md_archive (key TEXT PRIMARY KEY, value)")
+        state = dict(archive.execute("SELECT key, value FROM things2md_archive"))
+
+        # rebuild the archive if it was built from another database, or one of another version
+        (version,) = archive.execute("SELECT value FROM live.Meta WHERE key = 'databaseVersion'").fetchone()
+        if state.get('filepath') != database_file_path or state.get('version') != version:
+            for table in ARCHIVE_TABLES:
+                archive.execute(f"DROP TABLE IF EXISTS main.{table}")
+                (table_sql,) = archive.execute("SELECT sql FROM live.sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()
+                archive.execute(table_sql)
+            archive.executescript(ARCHIVE_INDEXES_SQL)
+            state = {}
+
+        with archive:
+            # these are small (and projects' titles, for example, may change), so they're copied in full
+            for table in ("Meta", "TMArea", "TMAreaTag", "TMTag"):
+                archive.execute(f"DELETE FROM main.{table}")
+                archive.execute(f"INSERT INTO main.{table} SELECT * FROM live.{table}")
+            archive.execute("DELETE FROM main.TMTask WHERE type != 0")
+            archive.execute("INSERT INTO main.TMTask SELECT * FROM live.TMTask WHERE type != 0")
+
+            # to-dos completed since the last update, or modified since (e.g., renamed, reopened, or trashed)
+            archive.execute("DROP TABLE IF EXISTS temp.changed")
+            archive.execute('''CREATE TEMP TABLE changed AS SELECT uuid FROM live.TMTask
+                WHERE type = 0 AND (stopDate >= ? OR userModificationDate >= ?)''',
+                (state.get('archived_until', 0), state.get('updated_at', 0)))
+            archive.execute('''DELETE FROM main.TMTask
+                WHERE uuid IN (SELECT uuid FROM temp.changed) OR uuid NOT IN (SELECT uuid FROM live.TMTask)''')
+            archived_count = archive.execute('''INSERT INTO main.TMTask SELECT * FROM live.TMTask
+                WHERE uuid IN (SELECT uuid FROM temp.changed) AND status IN (2, 3) AND stopDate < ? AND trashed = 0''',
+                (archived_until,)).rowcount
+
+            # their tags and checklist items; and those of projects, which are copied in full
+            archive.execute('''DELETE FROM main.TMTaskTag WHERE tasks IN (SELECT uuid FROM temp.changed)
+                OR tasks IN (SELECT uuid FROM main.TMTask WHERE type != 0) OR tasks NOT IN (SELECT uuid FROM main.TMTask)''')
+            archive.execute('''INSERT INTO main.TMTaskTag SELECT * FROM live.TMTaskTag
+                WHERE tasks IN (SELECT uuid FROM main.TMTask WHERE type != 0 OR uuid IN (SELECT uuid FROM temp.changed))''')
+            archive.execute('''DELETE FROM main.TMChecklistItem
+                WHERE task IN (SELECT uuid FROM temp.changed) OR task NOT IN (SELECT uuid FROM main.TMTask)''')
+            archive.execute('''INSERT INTO main.TMChecklistItem SELECT * FROM live.TMChecklistItem
+                WHERE task IN (SELECT uuid FROM main.TMTask WHERE uuid IN (SELECT uuid FROM temp.changed))''')
+
+            archive.executemany("INSERT OR REPLACE INTO things2md_archive (key, value) VALUES (?, ?)",
+                                dict(filepath=database_file_path, version=version, archived_until=archived_until,
+                                     updated_at=updated_at).items())
+        archive.close()
+    except (sqlite3.Error, OSError, TypeError) as e:
+        sys.stderr.write(f"things2md: Unable to update archive of Things database: {database_file_path}: {e}\n")
+        exit(1)
+
+    return archived_count, archived_until
+
+def write_completion_names():
+    '''
+    Reads the names of projects, areas, and tags from the databases (as --project, --area, and --tag match them,
+    e.g., without emojis if filtered), and of templates from the configuration, and caches them for completion
+    (see THINGS2MD_COMPLETION_FILE), along with the state they were read in. Returns the lines of names.
+    '''
+    completion_state = get_completion_state(get_database_filepaths())
+    sql_query = """
+        SELECT 'project' AS kind, title FROM TMTask WHERE type = 1 AND trashed = 0
+        UNION ALL SELECT 'area', title FROM TMArea
+        UNION ALL SELECT 'tag', title FROM TMTag
+        """
+    names = {}
+    for rows in query_databases(lambda: get_database().execute_query(sql_query)):
+        for row in rows:
+            title_filter = {'area': filter_area_title, 'project': filter_project_title}.get(row['kind'])
+            names[(row['kind'], title_filter(row['title']) if title_filter else row['title'])] = None
+    names.update(dict.fromkeys(('template', name) for name in CONFIG.templates))
+    lines = [f"{kind}\t{name}\n" for kind, name in sorted(names) if name and "\n" not in name and "\t" not in name]
+
+    # caches are optional, so failures are ignored
+    completion_file_path = os.path.join(os.path.dirname(__file__), THINGS2MD_COMPLETION_FILE)
+    try:
+        os.makedirs(os.path.dirname(completion_file_path), exist_ok=True)
+        temp_file_path = f"{completion_file_path}.{os.getpid()}.tmp"
+        with open(temp_file_path, "w", encoding="utf-8") as completion_file:
+            completion_file.write("\t".join(completion_state) + "\n")
+            completion_file.writelines(lines)
+        os.replace(temp_file_path, completion_file_path)
+    except OSError:
         pass
-    elif ARG_TAG:
+    return lines
+
+def write_coalesced_result():
+    '''
+    Shares this run's output with the concurrent identical runs waiting on it, if any (see coalesce_invocation);
+    or keeps it, if the run has a --deadline, to output instead when a later run reaches it (see exit_with_cached_output).
+    Only called once the run has succeeded, so that failures aren't shared.
+    Files last written before today are removed, as their keys (see get_invocation_key) can't recur.
+    '''
+    if COALESCE:
+        if DEADLINE is not None or os.path.exists(COALESCE['wait_file_path']):
+            write_cache_file(COALESCE['result_file_path'], dict(finished_at=time.time(), stdout=sys.stdout.output.getvalue(),
+                                                                 stderr=sys.stderr.output.getvalue()))
+            try:
+                os.remove(COALESCE['wait_file_path'])
+            except OSError:
+                pass # e.g., there was no run waiting
+        today_timestamp = datetime(TODAY_DATE.year, TODAY_DATE.month, TODAY_DATE.day).timestamp()
+        try:
+            with os.scandir(os.path.dirname(COALESCE['result_file_path'])) as entries:
+                stale_file_paths = [entry.path for entry in entries
+                                    if entry.name.startswith("coalesce-") and entry.stat().st_mtime < today_timestamp]
+        except OSError:
+            stale_file_paths = [] # caches are optional
+        for stale_file_path in stale_file_paths:
+            try:
+                os.remove(stale_file_path)
+            except OSError:
+                pass # e.g., removed by a concurrent run
+
+def write_render_cache(scope, fragments, used_uuids):
+    '''
+    Caches the given newly rendered output (uuid -> (fingerprint, template variables, markdown)) of tasks in the
+    given scope, and marks the cached output of the given tasks as used. The least recently used output beyond
+    RENDER_CACHE_SIZE is evicted. Caches are optional, so failures are ignored.
+    '''
+    if not fragments and not used_uuids:
+        return
+    used_at = time.time()
+    try:
+        cache = open_render_cache()
+        with cache:
+            cache.executemany("INSERT OR REPLACE INTO fragment VALUES (?, ?, ?, ?, ?, ?)",
+                              ((scope, uuid, fingerprint, pickle.dumps(vars, protocol=pickle.HIGHEST_PROTOCOL), markdown, used_at)
+                               for uuid, (fingerprint, vars, markdown) in fragments.items()))
+            cache.executemany("UPDATE fragment SET used_at = ? WHERE scope = ? AND uuid = ?",
+                              ((used_at, scope, uuid) for uuid in used_uuids))
+            if fragments:
+                excess = cache.execute("SELECT COUNT(*) FROM fragment").fetchone()[0] - RENDER_CACHE_SIZE
+                if excess > 0:
+                    cache.execute('''
+                        DELETE FROM fragment WHERE (scope, uuid) IN (
+                            SELECT scope, uuid FROM fragment ORDER BY used_at LIMIT ?)
+                        ''', (excess,))
+        cache.close()
+    except (sqlite3.Error, OSError):
         pass
-    else:
-        tasks.sort(key=lambda x: x['stop_date'] if x['stop_date'] is not None else float('-inf'), reverse=True)
+    if DEBUG: print(f"\nRENDER CACHE: {len(fragments)} tasks rendered, {len(used_uuids)} marked as used")
 
-    return tasks[:QUERY_LIMIT]
+def write_since_last_mark(state_file_path, mark, tasks):
+    '''
+    Advances the given --since-last mark past the given tasks, and atomically writes it to the state file.
+    '''
+    stop_dates = [task['stop_date'] for task in tasks if task['stop_date'] is not None]
+    if not stop_dates:
+        return
+    latest_stop_date = max(stop_dates)
+    uuids = [task['uuid'] for task in tasks if task['stop_date'] == latest_stop_date]
+    if mark and mark['stop_date'] == latest_stop_date:
+        uuids = mark['uuids'] + uuids
+    if DEBUG: print(f"\nSINCE LAST: {latest_stop_date} {uuids}")
+
+    try:
+        temp_file_path = f"{state_file_path}.{os.getpid()}.tmp"
+        with open(temp_file_path, "w", encoding="utf-8") as state_file:
+            json.dump(dict(stop_date=latest_stop_date, uuids=uuids), state_file)
+        os.replace(temp_file_path, state_file_path)
+    except OSError as e:
+        sys.stderr.write(f"things2md: Unable to write state file: {state_file_path}: {e}\n")
+        exit(1)
+
+def write_notes(rows, output_dir):
+    '''
+    Writes each of the given (template variables, markdown) rows to its own file in the given directory,
+    on a thread pool. Files whose contents are unchanged (per the hashes in the directory's manifest, as
+    of the last time they were written) are left alone, so that they aren't needlessly touched.
+    Files written before for tasks no longer output (e.g., since renamed) are removed, unless edited since.
+    '''
+    manifest_file_path = os.path.join(output_dir, THINGS2MD_MANIFEST_FILE)
+    try:
+        os.makedirs(output_dir, exist_ok=True)
+        with open(manifest_file_path, encoding="utf-8") as manifest_file:
+            manifest = json.load(manifest_file)
+    except FileNotFoundError:
+        manifest = {}
+    except (OSError, ValueError) as e:
+        sys.stderr.write(f"things2md: Unable to read manifest: {manifest_file_path}: {e}\n")
+        exit(1)
+
+    # name files after their tasks; tasks with the same name are told apart by uuid, ignoring case
+    # as file systems may (e.g., macOS')
+    files = {}
+    for row_vars, row_md in rows:
+        filename = get_note_filename(row_vars['title'], row_vars['uuid'])
+        if filename.casefold() in files:
+            filename = get_note_filename(f"{filename[:-3]} {row_vars['uuid']}", row_vars['uuid'])
+        files[filename.casefold()] = (filename, row_md if row_md.endswith("\n") else row_md + "\n")
+    files = dict(files.values())
+
+    changed_files = {}
+    for filename, contents in files.items():
+        contents_hash = hashlib.sha256(contents.encode("utf-8")).hexdigest()
+        if manifest.get(filename) != contents_hash or not os.path.exists(os.path.join(output_dir, filename)):
+            changed_files[filename] = (contents, contents_hash)
+    filenames = {filename.casefold(): filename for filename in files}
+    removed_files = [filename for filename in manifest if filename not in files]
+    if DEBUG: print(f"\nNOTES: {len(changed_files)} of {len(files)} changed in {output_dir}, {len(removed_files)} removed")
+
+    def write_note(filename, contents):
+        file_path = os.path.join(output_dir, filename)
+        temp_file_path = f"{file_path}.{os.getpid()}.tmp"
+        with open(temp_file_path, "w", encoding="utf-8") as note_file:
+            note_file.write(contents)
+        os.replace(temp_file_path, file_path)
+
+    def remove_note(filename):
+        file_path = os.path.join(output_dir, filename)
+        try:
+            if filename.casefold() in filenames and os.path.samefile(file_path, os.path.join(output_dir, filenames[filename.casefold()])):
+                return False # renamed in case only, on a file system that ignores it
+            with open(file_path, "rb") as note_file:
+                if hashlib.sha256(note_file.read()).hexdigest() != manifest[filename]:
+                    return False # edited since it was written, so it's kept
+            os.remove(file_path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    try:
+        with ThreadPoolExecutor() as executor:
+            for _ in executor.map(write_note, changed_files, (contents for contents, _ in changed_files.values())):
+                pass
+            removed_count = sum(executor.map(remove_note, removed_files))
+        # only this output's files are kept in the manifest (by their names' current case, too)
+        written_manifest = {filename: changed_files[filename][1] if filename in changed_files else manifest[filename]
+                            for filename in files}
+        if written_manifest != manifest:
+            manifest = written_manifest
+            temp_file_path = f"{manifest_file_path}.{os.getpid()}.tmp"
+            with open(temp_file_path, "w", encoding="utf-8") as manifest_file:
+                json.dump(manifest, manifest_file, indent=1, sort_keys=True, ensure_ascii=False)
+            os.replace(temp_file_path, manifest_file_path)
+    except OSError as e:
+        sys.stderr.write(f"things2md: Unable to write notes: {e}\n")
+        exit(1)
+
+    removed_note = f", {removed_count} removed" if removed_count else ""
+    sys.stderr.write(f"things2md: Wrote {len(changed_files)} notes to {output_dir} ({len(files) - len(changed_files)} unchanged{removed_note})\n")
 
 def remove_emojis(input_string):
     '''
@@ -411,7 +2492,7 @@ def filter_area_title(area_title):
     Applies filters to the name of the area for output according to provided arguments.
     '''
     output = area_title
-    if CFG_REMOVE_AREA_EMOJIS:
+    if CONFIG.remove_area_emojis:
         output = remove_emojis(output)
     return output
 
@@ -420,7 +2501,7 @@ def filter_heading_title(heading_title):
     Applies filters to  the name of the heading for output according to provided arguments.
     '''
     output = heading_title
-    if CFG_REMOVE_HEADING_EMOJIS:
+    if CONFIG.remove_heading_emojis:
         output = remove_emojis(output)
     return output
 
@@ -429,7 +2510,7 @@ def filter_project_title(project_title):
     Applies filters to  the name of the project for output according to provided arguments.
     '''
     output = project_title
-    if CFG_REMOVE_PROJECT_EMOJIS:
+    if CONFIG.remove_project_emojis:
         output = remove_emojis(output)
     return output
 
@@ -438,10 +2519,22 @@ def filter_task_title(task_title):
     Applies filters to  the name of the task for output according to provided arguments.
     '''
     output = task_title
-    if CFG_REMOVE_TASK_EMOJIS:
+    if CONFIG.remove_task_emojis:
         output = remove_emojis(output)
     return output
 
+def filter_tasks(tasks):
+    '''
+    Applies filters to the given tasks' titles and notes, for output according to provided arguments.
+    '''
+    for task in tasks:
+        task['notes'] = filter_notes(task['notes'])
+        if CONFIG.remove_task_emojis: task['title'] = filter_task_title(task['title'])
+        if CONFIG.remove_project_emojis and 'project_title' in task:
+            task['project_title'] = filter_project_title(task['project_title'])
+        if CONFIG.remove_heading_emojis and 'heading_title' in task:
+            task['heading_title'] = filter_heading_title(task['heading_title'])
+
 def filter_notes(notes):
     '''
     Filters notes by replacing non http links with markdown links.
@@ -464,6 +2557,30 @@ def filter_notes(notes):
 
 if DEBUG: print("PARAMS:\n{}".format(args))
 
+if ARG_COMPLETION:
+    print(get_completion_script(ARG_COMPLETION))
+    exit(0)
+
+if ARG_COMPLETE:
+    # the cached names were out of date, or missing (otherwise they'd have been output before the imports)
+    print_completion_names(write_completion_names(), *ARG_COMPLETE[:2])
+    exit(0)
+
+if ARG_ARCHIVE:
+    for database_file_path, (archived_count, archived_until) in zip(get_database_filepaths(), query_databases(update_archive)):
+        sys.stderr.write(f"things2md: Archived {archived_count} new or modified tasks completed before {format_date(archived_until)}: {database_file_path}\n")
+    exit(0)
+
+if ARG_DEADLINE is not None:
+    DEADLINE = time.monotonic() + ARG_DEADLINE
+
+# concurrent runs with the same arguments share the output of one of them (e.g., from the same command in an
+# Obsidian template, run more than once at a time); not runs which write files, or debug output. Past the
+# deadline, the output last shared is output instead
+invocation_key = get_invocation_key()
+if not (ARG_OUTPUT_DIR or ARG_SINCE_LAST or DEBUG):
+    coalesce_invocation(invocation_key)
+
 start_datetime = None
 end_datetime = None
 if ARG_RANGE is not None:
@@ -472,6 +2589,51 @@ if ARG_RANGE is not None:
         sys.stderr.write(f"things2md: Error: Invalid date range: {ARG_RANGE}")
         exit(errno.EINVAL) # Invalid argument error code
     if DEBUG: print(f"\nDATE RANGE:\n\"{ARG_RANGE}\" == {start_datetime} to {end_datetime}")
+elif ARG_DATE is not None:
+    start_datetime = ARG_DATE.astimezone()
+    end_datetime = start_datetime + relativedelta(days=1)
+
+# explicit bounds override those of --range or --date
+if ARG_SINCE is not None:
+    start_datetime, _ = get_datetime_period(ARG_SINCE)
+    if start_datetime is None:
+        sys.stderr.write(f"things2md: Error: Invalid date: {ARG_SINCE}")
+        exit(errno.EINVAL) # Invalid argument error code
+if ARG_UNTIL is not None:
+    _, end_datetime = get_datetime_period(ARG_UNTIL)
+    if end_datetime is None:
+        sys.stderr.write(f"things2md: Error: Invalid date: {ARG_UNTIL}")
+        exit(errno.EINVAL) # Invalid argument error code
+if DEBUG and (ARG_SINCE or ARG_UNTIL): print(f"\nDATE BOUNDS:\n{start_datetime} to {end_datetime} (exclusive)")
+
+# tasks completed within past dates are fetched from the archives covering them (see --archive), if any;
+# not for --projects, which lists projects as they are now
+if end_datetime is not None and not ARG_PROJECTS:
+    for database_file_path in get_database_filepaths():
+        archived_until = get_archived_until(get_archive_filepath(database_file_path))
+        if archived_until is not None and end_datetime.timestamp() <= archived_until:
+            ARCHIVES[database_file_path] = get_archive_filepath(database_file_path)
+    if DEBUG and ARCHIVES: print(f"\nARCHIVES:\n{ARCHIVES}")
+
+# archives aren't written by Things, so only the databases themselves are copied
+if ARG_SNAPSHOT is not None:
+    for database_file_path in get_database_filepaths():
+        if database_file_path in ARCHIVES.values():
+            continue
+        try:
+            SNAPSHOTS[database_file_path] = get_snapshot(database_file_path, ARG_SNAPSHOT)
+        except (sqlite3.Error, OSError) as e:
+            sys.stderr.write(f"things2md: Unable to open Things database: {database_file_path}: {e}\n")
+            exit(1)
+
+if ARG_WHERE:
+    where_sql, where_parameters, ARG_WHERE_ANY_STATUS = compile_where(ARG_WHERE)
+    ARG_WHERE_PREDICATE = (where_sql, where_parameters)
+    if DEBUG: print(f"\nWHERE:\n{ARG_WHERE_PREDICATE}")
+
+if ARG_SINCE_LAST:
+    ARG_SINCE_LAST_MARK = read_since_last_mark(ARG_SINCE_LAST)
+    if DEBUG: print(f"\nSINCE LAST:\n{ARG_SINCE_LAST_MARK}")
 
 if DEBUG: print(f"\nTODAY: {TODAY}, TODAY_DATE: {TODAY_DATE}, TODAY_INT: {TODAY_INT}, TODAY_TIMESTAMP: {TODAY_TIMESTAMP}")
 
@@ -479,14 +2641,39 @@ if DEBUG: print(f"\nTODAY: {TODAY}, TODAY_DATE: {TODAY_DATE}, TODAY_INT: {TODAY_
 # Get Areas + Projects
 #
 
+if ARG_TREE and CFG_TEMPLATE.get("heading") is None:
+    sys.stderr.write(f"things2md: {THINGS2MD_CONFIG_FILE} ({ARG_TEMPLATE}): All of these params are required for --tree: heading")
+    exit(1)
+
+# areas, projects, and tasks are fetched concurrently, except for what depends on the area or project
+# requested (or, for ordering by area, on the projects' areas), which is fetched once those are resolved
+queries = {'areas': query_areas}
+if not ARG_AREA:
+    queries['projects'] = lambda: query_projects(start_datetime)
+if not (ARG_AREA or ARG_PROJECT or ARG_PROJECTS or ARG_STATS is not None or ARG_ORDERBY == 'area'):
+    queries['tasks'] = lambda: query_task_results(start_datetime, end_datetime)
+if CONFIG.vault and ARG_STATS is None:
+    queries['vault'] = lambda: load_vault_links(CONFIG.vault)
+query_results = dict(zip(queries, query_concurrently(*queries.values())))
+
 # get area names
 areas = dict()
-area_results = query_areas()
+area_results = query_results['areas']
 for area in area_results:
     areas[area['uuid']] = area
+    if ARG_AREA:
+        if ARG_AREA in (area['title'], filter_area_title(area['title'])):
+            ARG_AREA_UUID = area['uuid']
+
+if ARG_AREA and ARG_AREA_UUID is None:
+    sys.stderr.write(f"things2md: Area not found: {ARG_AREA}")
+    exit(errno.EINVAL) # Invalid argument error code
 
 projects = {}
-project_results = query_projects(start_datetime)
+if 'projects' in query_results:
+    project_results = query_results['projects']
+else:
+    project_results = query_projects(start_datetime)
 # format projects:
 # store in associative array for easier reference later
 if DEBUG: print(f"PROJECTS ({len(project_results)}):")
@@ -501,27 +2688,73 @@ if ARG_PROJECT and ARG_PROJECT_UUID is None:
     sys.stderr.write(f"things2md: Project not found: {ARG_PROJECT}")
     exit(errno.EINVAL) # Invalid argument error code
 
+#
+# Get Stats
+#
+
+if ARG_STATS is not None:
+    _required_params = ["stats_header", "stats_row"]
+    if any(CFG_TEMPLATE.get(param) is None for param in _required_params):
+        sys.stderr.write(f"things2md: {THINGS2MD_CONFIG_FILE} ({ARG_TEMPLATE}): All of these params are required for --stats: {', '.join(_required_params)}")
+        exit(1)
+
+    # each dimension is counted concurrently
+    dimensions = ARG_STATS or list(STATS_DIMENSIONS)
+    dimension_stats = query_concurrently(*(lambda dimension=dimension: query_stats(start_datetime, end_datetime, dimension)
+                                           for dimension in dimensions))
+    stats_outputted = 0
+    for dimension, stats in zip(dimensions, dimension_stats):
+        if DEBUG: print(f"\nSTATS ({dimension}):\n{stats}")
+        if not stats:
+            continue
+        header_vars = dict(dimension=dimension.title(), completed=CONFIG.status_symbols.get('completed', ""),
+                           canceled=CONFIG.status_symbols.get('canceled', ""))
+        try:
+            print(CFG_TEMPLATE.get("stats_header").format(**header_vars))
+            for group in stats:
+                total = group['completed'] + group['canceled']
+                row_vars = dict(group, total=total, canceled_ratio=f"{group['canceled'] / total:.0%}")
+                print(CFG_TEMPLATE.get("stats_row").format(**row_vars))
+        except KeyError as e:
+            sys.stderr.write(f"things2md: Invalid stats template variable: '{e.args[0]}'.")
+            exit(1)
+        stats_outputted += 1
+
+    if stats_outputted == 0:
+        sys.stderr.write(f"things2md: No results met the given criteria!\n")
+    write_coalesced_result()
+    exit(0)
+
 #
 # Get Tasks
 #
 
-task_results = {}
 # don't need to get tasks if we're just getting the projects list
-if not ARG_PROJECTS:
-    task_results = query_tasks(start_datetime, end_datetime)
+if ARG_PROJECTS:
+    task_results, heading_results, next_cursor = project_results, [], None
+elif 'tasks' in query_results:
+    task_results, heading_results, next_cursor = query_results['tasks']
 else:
-    task_results = project_results
+    task_results, heading_results, next_cursor = query_task_results(start_datetime, end_datetime)
+
+if DEADLINE_REACHED and not task_results:
+    exit_with_cached_output()
 
 #
 # Process All The Things
 # 
 
 things_outputted = []
-things_skipped = {}
+things_skipped = set() # uuids of tasks/projects skipped
+rendered_rows = [] # (template variables, markdown) for each task/project output
 
-header_area_previous = "PROJECTAREAPREVIOUS"
-header_date_previous = ""
-header_project_previous = "TASKPROJECTPREVIOUS"
+# tasks' output is cached, per template and configuration (see get_render_scope), so only those new or
+# modified since they were last output (see get_render_fingerprint) are rendered
+render_scope = get_render_scope()
+render_cache = read_render_cache(render_scope, [task['uuid'] for task in task_results])
+rendered_fragments = {} # uuid -> (fingerprint, template variables, markdown) for each task/project rendered
+used_fragments = [] # uuids of tasks/projects whose cached output was reused, and is due to be marked as used
+render_used_at = time.time() - RENDER_CACHE_TOUCH_INTERVAL
 
 if DEBUG: print(f"\nTASKS ({len(task_results)}):")
 
@@ -529,12 +2762,20 @@ for task in task_results:
 
     # skip this task if requested
     if has_skip_tags(task):
-        things_skipped[task['uuid']] = dict(task)
-        if DEBUG: print(f"... SKIPPED (TAG): {dict(task)}")
+        things_skipped.add(task['uuid'])
+        if DEBUG: print(f"... SKIPPED (TAG): {task}")
         continue
 
     if DEBUG: print(dict(task))
 
+    fingerprint = get_render_fingerprint(task)
+    cached = render_cache.get(task['uuid'])
+    if cached and cached[0] == fingerprint:
+        rendered_rows.append((pickle.loads(cached[1]), cached[2]))
+        if cached[3] < render_used_at: used_fragments.append(task['uuid'])
+        things_outputted.append(task)
+        continue
+
     #
     # map Things data to template variables
     #
@@ -546,14 +2787,15 @@ for task in task_results:
     project_md = ""
     
     # these variables apply to both tasks and projects
-    vars['date'] = f"{datetime.fromisoformat(task['stop_date']).date()}" if task['stop_date'] is not None else ""
-    vars['date_sep'] = CFG_DATE_SEPARATOR if vars['date'] else ""
-    vars['deadline'] = task['deadline'] if task['deadline'] is not None else ""
-    vars['deadline_sep'] = CFG_DEADLINE_SEPARATOR if vars['deadline'] else ""
+    vars['checklist'] = ""
+    vars['date'] = format_date(task['stop_date']) if task['stop_date'] is not None else ""
+    vars['date_sep'] = CONFIG.date_sep if vars['date'] else ""
+    vars['deadline'] = format_things_date(task['deadline']) if task['deadline'] is not None else ""
+    vars['deadline_sep'] = CONFIG.deadline_sep if vars['deadline'] else ""
     vars['gcal_url'] = get_gcal_url(task['uuid'], task['title'])
     vars['notes'] = task['notes'] if task['notes'] else None
     vars['url'] = things.link(task['uuid'])
-    vars['status'] = CFG_STATUS_SYMBOLS.get(task['status'], "")
+    vars['status'] = CONFIG.status_symbols.get(task['status'], "")
     # TODO: consider other tag list formats (e.g., for frontmatter lists)
     vars['tags'] = "#" + " #".join(task['tags']) if 'tags' in task else ""
     vars['title'] = task['title']
@@ -562,13 +2804,19 @@ for task in task_results:
     if task['type'] == "to-do":
 
         vars['heading'] = task['heading_title'] if 'heading_title' in task else ""
-        vars['heading_sep'] = CFG_HEADING_SEPARATOR if vars['heading'] else ""
-        vars['project'] = projects[task['project']]['title'] if 'project' in task else ""
-
-        # if this task has a heading, we have to get the project name from the heading's task
-        if not vars['project'] and ('heading' in task) and (heading_task := things.tasks(uuid=task['heading'])):
-            vars['project'] = filter_project_title(heading_task['project_title'])
-        vars['project_sep'] = CFG_PROJECT_SEPARATOR if vars['project'] else ""
+        vars['heading_uuid'] = task['heading'] if 'heading' in task else ""
+        vars['heading_sep'] = CONFIG.heading_sep if vars['heading'] else ""
+        # the task's project may not have been fetched (e.g., if it was completed before the range), so its title
+        # falls back to that of the task's row
+        project = projects.get(task['project']) if 'project' in task else None
+        vars['project'] = project['title'] if project else task.get('project_title', "")
+
+        # if this task has a heading, the project is that of the heading (see include_task_items)
+        if not vars['project'] and 'heading_project_title' in task:
+            vars['project'] = filter_project_title(task['heading_project_title'])
+        vars['project_sep'] = CONFIG.project_sep if vars['project'] else ""
+        vars['area'] = get_area_title(task)
+        vars['area_sep'] = CONFIG.area_sep if vars['area'] else ""
         if not CFG_TEMPLATE.get('type'):
             # attempt merge with template
             try:
@@ -582,10 +2830,10 @@ for task in task_results:
             if 'checklist' in task and task['checklist']:
                 for checklist_item in task.get('checklist'):
                     checklist_item_vars = {}
-                    if CFG_REMOVE_EMPTY_CHECKLIST_ITEMS and not checklist_item['title']:
+                    if CONFIG.remove_empty_checklist_items and not checklist_item['title']:
                         continue
                     checklist_item_vars['title'] = checklist_item['title']
-                    checklist_item_vars['status'] = CFG_STATUS_SYMBOLS.get(checklist_item['status'], "")
+                    checklist_item_vars['status'] = CONFIG.status_symbols.get(checklist_item['status'], "")
                     if checklist_md: checklist_md += "\n"
                     if CFG_TEMPLATE.get("checklist_item"):
                         checklist_md += CFG_TEMPLATE.get("checklist_item").format(**checklist_item_vars)
@@ -599,11 +2847,11 @@ for task in task_results:
         # skip if project's area has SKIP_TAGS
         if 'area' in task:
             if has_skip_tags(task):
-                things_skipped[task['uuid']] = dict(task)
-                if DEBUG: print(f"... SKIPPED (AREA TAG): {dict(task)}")
+                things_skipped.add(task['uuid'])
+                if DEBUG: print(f"... SKIPPED (AREA TAG): {task}")
                 continue
         vars['area'] = task['area_title'] if 'area_title' in task else ""
-        vars['area_sep'] = CFG_AREA_SEPARATOR if vars['area'] else ""
+        vars['area_sep'] = CONFIG.area_sep if vars['area'] else ""
         vars['title'] = task['title']
 
         # attempt merge with template
@@ -614,42 +2862,13 @@ for task in task_results:
             exit(1)
 
     elif task['type'] == "heading":
-        # TODO: do something for --project output
-        pass
+        # headings are only output by --tree, around their tasks (see print_tree)
+        continue
 
     else:
         # areas?
         sys.stderr.write(f"things2md: DEBUG: UNHANDLED TYPE: {task['type']}")
 
-    #
-    # prepare groupby headers
-    #
-
-    if ARG_GROUPBY == "date" and CFG_TEMPLATE.get("groupby_date"):
-        if vars['date'] != header_date_previous:
-            try:
-                print(CFG_TEMPLATE.get("groupby_date").format(**vars))
-            except KeyError as e:
-                sys.stderr.write(f"things2md: Invalid groupby_date template variable: '{e.args[0]}'.")
-                exit(1)
-            header_date_previous = vars['date']
-    elif ARG_GROUPBY == "project" and CFG_TEMPLATE.get("groupby_project"):
-        if 'project' in vars and vars['project'] and vars['project'] != header_project_previous:
-            try:
-                print(CFG_TEMPLATE.get("groupby_project").format(**vars))
-            except KeyError as e:
-                sys.stderr.write(f"things2md: Invalid groupby_project template variable: '{e.args[0]}'.")
-                exit(1)
-            header_project_previous = vars['project']
-    elif ARG_GROUPBY == "area" and CFG_TEMPLATE.get("groupby_area"):
-        if 'area' in vars and vars['area'] != header_area_previous:
-            try:
-                print(CFG_TEMPLATE.get("groupby_area").format(**vars))
-            except KeyError as e:
-                sys.stderr.write(f"things2md: Invalid groupby_area template variable: '{e.args[0]}'.")
-                exit(1)
-            header_area_previous = vars['area']
-
     #
     # output
     #
@@ -658,13 +2877,15 @@ for task in task_results:
     if CFG_TEMPLATE.get('type') == 'markdown_note':
         # markdown_note
         try:
-            md_output = CFG_TEMPLATE.get("title").format(**vars)
-            md_output += CFG_TEMPLATE.get("body").format(**vars)
+            note_vars = dict(vars, notes=vars['notes'] or "") # output missing notes as empty
+            md_output = CFG_TEMPLATE.get("title").format(**note_vars)
+            md_output += CFG_TEMPLATE.get("body").format(**note_vars)
         except KeyError as e:
             sys.stderr.write(f"things2md: Invalid markdown_note body template variable: '{e.args[0]}'.")
             exit(1)
 
-        print(md_output)
+        rendered_rows.append((vars, md_output))
+        rendered_fragments[task['uuid']] = (fingerprint, vars, md_output)
     else:
         # prepare task + project output
         md_output = md_output.replace("[[]]", "") # remove empty wikilinks
@@ -679,12 +2900,32 @@ for task in task_results:
                 sys.stderr.write(f"things2md: Invalid notes template variable: '{e.args[0]}'.")
                 exit(1)
 
-        print(md_output)
-        if notes_md: print(indent_string(notes_md))
-        if checklist_md: print(indent_string(checklist_md))
+        md_lines = [md_output]
+        if notes_md: md_lines.append(indent_string(notes_md))
+        if checklist_md: md_lines.append(indent_string(checklist_md))
+        rendered_rows.append((vars, "\n".join(md_lines)))
+        rendered_fragments[task['uuid']] = (fingerprint, vars, rendered_rows[-1][1])
 
     things_outputted.append(task)
 
+#
+# Group + Output
+#
+
+# resolved once cached, so that cached output doesn't depend on the vault
+if CONFIG.vault:
+    rendered_rows = [(vars, resolve_output_wikilinks(markdown, query_results['vault'])) for vars, markdown in rendered_rows]
+
+if ARG_OUTPUT_DIR:
+    write_notes(rendered_rows, ARG_OUTPUT_DIR)
+elif ARG_TREE:
+    print_tree(build_tree(rendered_rows, heading_results))
+else:
+    print_groups(group_rows(rendered_rows, ARG_GROUPBY), ARG_GROUPBY)
+
+# cache what was rendered once it's output, so as not to hold up the output
+write_render_cache(render_scope, rendered_fragments, used_fragments)
+
 #
 # Summarize
 # 
@@ -696,8 +2937,23 @@ if DEBUG:
 if len(things_skipped) > 0:
     sys.stderr.write(f"things2md: Skipped {len(things_skipped)} tasks or projects with specified skip_tags\n")
 
-if len(things_outputted) == 0:
+if ARG_SINCE_LAST:
+    # only once output, so that tasks aren't missed if output fails
+    write_since_last_mark(ARG_SINCE_LAST, ARG_SINCE_LAST_MARK, task_results)
+
+if next_cursor:
+    sys.stderr.write(f"things2md: Output limited to {ARG_LIMIT} tasks; continue with: --after {next_cursor}\n")
+
+if DEADLINE_REACHED:
+    # not shared with concurrent identical runs (see write_coalesced_result), as it's incomplete
+    sys.stderr.write(f"things2md: Deadline of {ARG_DEADLINE:g} seconds reached; output is partial ({len(things_outputted)} tasks)\n")
+    exit(errno.ETIMEDOUT)
+
+if len(things_outputted) == 0 and not next_cursor:
     sys.stderr.write(f"things2md: No results met the given criteria!\n")
+    write_coalesced_result()
     exit(0)
 
+write_coalesced_result()
+
 if DEBUG: print("\nDONE!")
\ No newline at end of file